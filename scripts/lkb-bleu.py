@@ -6,13 +6,7 @@ import docopt
 
 from delphin import itsdb
 
-from xmt.metrics import bleu
-
-from nltk.translate import bleu_score
-from nltk.tokenize.toktok import ToktokTokenizer
-
-_tokenize = ToktokTokenizer().tokenize
-_smoother = bleu_score.SmoothingFunction().method3
+from xmt.metrics import bleu, bleu_stats
 
 
 USAGE = '''
@@ -52,19 +46,11 @@ def oracle_pairs(p, refs):
     gs = groupby(p.join('parse', 'result'), key=lambda row: row['parse:i-id'])
     for i_id, group in gs:
         ref = refs[i_id]
-        scored = []
-        for res in group:
-            hyp = res['result:surface']
-            scored.append(
-                (
-                    bleu_score.sentence_bleu(
-                        [_tokenize(ref)], _tokenize(hyp),
-                        smoothing_function=_smoother
-                    ),
-                    hyp, ref
-                )
-            )
-        _, hyp, ref = sorted(scored, key=lambda r: r[0])[-1]
+        hyps = [res['result:surface'] for res in group]
+        scores = bleu_stats(
+            [(hyp, ref) for hyp in hyps], lowercase=False
+        ).sentence_scores()
+        _, hyp = sorted(zip(scores, hyps), key=lambda r: r[0])[-1]
         pairs.append((hyp, ref))
     return pairs
 
@@ -0,0 +1,196 @@
+
+import os
+import time
+import json
+import zlib
+import hashlib
+import sqlite3
+import threading
+import logging
+
+from delphin.interfaces.base import ParseResponse
+
+from xmt import util
+
+# evict at most every this many new entries, and write the access
+# times of at most this many hits at once
+_EVICT_INTERVAL = 1000
+
+# ACE's names for the keys that ParseResponse and ParseResult use
+_RESPONSE_KEYS = {'INPUT': 'input', 'RESULTS': 'results'}
+_RESULT_KEYS = {'MRS': 'mrs', 'DERIV': 'derivation', 'SENT': 'surface'}
+
+_grammar_digests = {}
+
+
+def grammar_digest(path):
+    """
+    Return a hex digest of the contents of the grammar image at *path*.
+
+    Digests are remembered for the life of the process as long as the
+    file's size and modification time do not change.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _grammar_digests:
+        _grammar_digests[key] = util.file_digest(path)
+    return _grammar_digests[key]
+
+
+def response_data(response):
+    """
+    Return the data of ACE *response* as a plain dictionary with the
+    keys of pydelphin's [ParseResponse] and [ParseResult] (e.g.,
+    `results` and `mrs` rather than ACE's `RESULTS` and `MRS`).
+    """
+    data = {_RESPONSE_KEYS.get(key, key): val
+            for key, val in dict(response).items()}
+    data['results'] = [
+        {_RESULT_KEYS.get(key, key): val for key, val in dict(r).items()}
+        for r in data.get('results', [])
+    ]
+    return data
+
+
+class AceCache(object):
+    """
+    A persistent, size-bounded cache of ACE responses.
+
+    Responses are stored in an SQLite database keyed on the
+    *namespace* and the input string or MRS, so one database may be
+    shared by several workspaces and grammars. When the stored
+    responses exceed *max_size*, the least-recently-used ones are
+    evicted. The access times of hits are written in batches, with
+    new responses or on close.
+
+    Args:
+        path: the path of the cache database
+        namespace: a list of JSON-serializable values (e.g., the
+            grammar digest and ACE command-line arguments) that,
+            together with an input, determine the response
+        max_size: the maximum size of stored responses in bytes
+    """
+
+    def __init__(self, path, namespace, max_size=1024 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._prefix = json.dumps(namespace, sort_keys=True)
+        self._added = 0
+        self._size = None  # of stored responses, once known
+        self._atimes = {}  # unwritten access times of hits
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60,
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' data BLOB,'
+                ' size INTEGER,'
+                ' atime REAL)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS atime_idx ON responses (atime)'
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _key(self, datum):
+        s = self._prefix + '\n' + datum.rstrip()
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def get(self, datum):
+        """
+        Return the cached response for *datum*, or `None` if there is
+        no cached response.
+        """
+        key = self._key(datum)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._atimes[key] = time.time()
+            if len(self._atimes) >= _EVICT_INTERVAL:
+                with self._db:
+                    self._write_atimes()
+        data = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        # entries stored by older versions have ACE's key names
+        return ParseResponse(response_data(data))
+
+    def put(self, datum, response):
+        """
+        Store *response* as the response for *datum*.
+        """
+        data = json.dumps(response_data(response))
+        data = zlib.compress(data.encode('utf-8'))
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (self._key(datum), data, len(data), time.time())
+            )
+            self._write_atimes()
+            if self._size is not None:
+                # replaced responses are counted twice until the
+                # total is read again
+                self._size += len(data)
+            self._added += 1
+            if self._added % _EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _write_atimes(self):
+        if self._atimes:
+            self._db.executemany(
+                'UPDATE responses SET atime = ? WHERE key = ?',
+                [(atime, key) for key, atime in self._atimes.items()]
+            )
+            self._atimes.clear()
+
+    def _evict(self):
+        if self._size is None or self._size > self.max_size:
+            # the total may be over-estimated, and other processes
+            # sharing the database add responses as well
+            self._size = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()[0]
+        excess = self._size - self.max_size
+        if excess <= 0:
+            return
+        # only the oldest responses are read, using the atime index
+        expired = []
+        rows = self._db.execute(
+            'SELECT key, size FROM responses ORDER BY atime'
+        )
+        for key, size in rows:
+            if excess <= 0:
+                break
+            expired.append((key,))
+            excess -= size
+            self._size -= size
+        rows.close()
+        logging.debug('Evicting {} responses from cache {}'
+                      .format(len(expired), self.path))
+        self._db.executemany(
+            'DELETE FROM responses WHERE key = ?', expired
+        )
+
+    def close(self):
+        """
+        Write the access times of hits, evict old responses if new
+        ones were added, and close the database.
+        """
+        with self._lock, self._db:
+            self._write_atimes()
+            if self._added % _EVICT_INTERVAL != 0:
+                self._evict()  # new responses since the last eviction
+        self._db.close()
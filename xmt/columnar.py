@@ -0,0 +1,318 @@
+
+import os
+import json
+import mmap
+import uuid
+import shutil
+import logging
+from array import array
+
+from delphin import itsdb
+
+from xmt import tables
+
+# a profile containing this file has its result tables kept in the
+# columnar format, including those written by later tasks
+MARKER = 'columnar'
+
+# tables that may be stored in the columnar format; the item and info
+# tables are small and stay readable by other [incr tsdb()] tools
+PACKED_TABLES = ('p-result', 'x-result', 'g-result', 'r-result')
+
+_SUFFIX = '.col'
+_META = 'meta.json'
+
+
+def do(args):
+    for i, itemdir in enumerate(args['ITEM']):
+        itemdir = os.path.normpath(itemdir)
+        p = itsdb.ItsdbProfile(itemdir)
+        if args['pack']:
+            pack(p)
+        else:
+            unpack(p)
+
+
+def enabled(p):
+    """
+    Return `True` if profile *p* keeps its result tables in the
+    columnar format.
+    """
+    return os.path.isfile(os.path.join(p.root, MARKER))
+
+
+def exists(root, table):
+    """
+    Return `True` if *table* of the profile at *root* is stored in the
+    columnar format.
+    """
+    return os.path.isfile(os.path.join(root, table + _SUFFIX, _META))
+
+
+def remove(root, table):
+    """
+    Remove the columnar version of *table* in the profile at *root*.
+    """
+    path = os.path.join(root, table + _SUFFIX)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def pack(p, tablenames=PACKED_TABLES):
+    """
+    Convert *tablenames* of profile *p* to the columnar format and mark
+    the profile so that tables written later are converted as well.
+    """
+    for table in tablenames:
+        pack_table(p, table)
+    open(os.path.join(p.root, MARKER), 'w').close()
+
+
+def unpack(p, tablenames=PACKED_TABLES):
+    """
+    Convert *tablenames* of profile *p* back to gzipped [incr tsdb()]
+    tables and remove the profile's columnar marker.
+    """
+    for table in tablenames:
+        unpack_table(p, table)
+    marker = os.path.join(p.root, MARKER)
+    if os.path.isfile(marker):
+        os.remove(marker)
+
+
+def pack_table(p, table):
+    """
+    Convert *table* of profile *p* from the [incr tsdb()] format to
+    the columnar format.
+
+    Columns whose values are all integers are stored as packed
+    64-bit integer arrays. Other columns are dictionary-encoded: each
+    distinct value is stored once and rows store its index.
+    """
+    try:
+        rows = p.read_table(table, key_filter=False)
+        fields = [f.name for f in p.table_relations(table)]
+        columns = {name: _ColumnBuilder() for name in fields}
+        n = 0
+        for row in rows:
+            for name in fields:
+                columns[name].add(row.get(name, ''))
+            n += 1
+    except itsdb.ItsdbError:
+        return False  # nothing to convert
+    path = os.path.join(p.root, table + _SUFFIX)
+    tmppath = path + '.tmp'
+    if os.path.isdir(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+    meta = {'table': table, 'rows': n, 'id': uuid.uuid4().hex,
+            'columns': []}
+    for name in fields:
+        encoding = columns[name].write(tmppath, name)
+        meta['columns'].append({'name': name, 'encoding': encoding})
+    with open(os.path.join(tmppath, _META), 'w') as fh:
+        json.dump(meta, fh)
+    remove(p.root, table)
+    os.replace(tmppath, path)
+    for filename in (table, table + '.gz'):
+        if os.path.isfile(os.path.join(p.root, filename)):
+            os.remove(os.path.join(p.root, filename))
+    logging.info('Packed {} rows of {}/{}'.format(n, p.root, table))
+    return True
+
+
+def unpack_table(p, table):
+    """
+    Convert *table* of profile *p* from the columnar format to a
+    gzipped [incr tsdb()] table.
+    """
+    if not exists(p.root, table):
+        return False
+    ct = ColumnarTable(p.root, table)
+    with tables.TableWriter(p, table) as writer:
+        for row in ct.rows():
+            writer.write(row)
+    remove(p.root, table)
+    logging.info('Unpacked {} rows of {}/{}'.format(len(ct), p.root, table))
+    return True
+
+
+def read_table(p, table):
+    """
+    Yield the rows of *table* in profile *p* like `p.read_table()`,
+    but from the columnar format if the table is stored that way.
+    """
+    if not exists(p.root, table):
+        yield from p.read_table(table)
+        return
+    # like p.read_table(), skip rows of items not in the item table
+    i_ids = set(i_id for i_id, in p.select('item', ['i-id']))
+    for row in ColumnarTable(p.root, table).rows():
+        if 'i-id' not in row or row['i-id'] in i_ids:
+            yield row
+
+
+def read_column(p, table, name):
+    """
+    Yield the values of column *name* of the rows of *table* in
+    profile *p*, like read_table(), but reading only that column (and
+    the i-id column) if the table is stored in the columnar format.
+    """
+    if not exists(p.root, table):
+        for row in p.read_table(table):
+            yield row[name]
+        return
+    t = ColumnarTable(p.root, table)
+    values = t.values(name)
+    if 'i-id' not in t.fields:
+        yield from values
+        return
+    i_ids = set(i_id for i_id, in p.select('item', ['i-id']))
+    for i_id, value in zip(t.values('i-id'), values):
+        if i_id in i_ids:
+            yield value
+
+
+class ColumnarTable(object):
+    """
+    A table stored in the columnar format.
+
+    Integer columns are memory-mapped rather than read, so opening a
+    table and reading some of its columns is cheap.
+    """
+
+    def __init__(self, root, table):
+        self.root = root
+        self.table = table
+        self.path = os.path.join(root, table + _SUFFIX)
+        with open(os.path.join(self.path, _META)) as fh:
+            meta = json.load(fh)
+        self.nrows = meta['rows']
+        self.fields = [col['name'] for col in meta['columns']]
+        self.encodings = {col['name']: col['encoding']
+                          for col in meta['columns']}
+
+    def __len__(self):
+        return self.nrows
+
+    def is_int(self, name):
+        """
+        Return `True` if column *name* is stored as integers.
+        """
+        return self.encodings[name] == 'int'
+
+    def ints(self, name):
+        """
+        Return a memory-mapped sequence of the integers in column
+        *name*, which must be stored as integers (see is_int()).
+        """
+        return _map_array(os.path.join(self.path, name + '.int'), 'q')
+
+    def strings(self, name):
+        """
+        Return a list of the values of column *name* as strings.
+        """
+        if self.is_int(name):
+            return [str(x) for x in self.ints(name)]
+        values = _read_dictionary(self.path, name)
+        codes = _map_array(os.path.join(self.path, name + '.codes'), 'i')
+        return [values[code] for code in codes]
+
+    def values(self, name):
+        """
+        Yield the values of column *name* as strings. Unlike
+        strings(), each value is decoded from the memory-mapped
+        column only when it is reached.
+        """
+        if self.is_int(name):
+            for x in self.ints(name):
+                yield str(x)
+            return
+        values = _Dictionary(self.path, name)
+        for code in _map_array(os.path.join(self.path, name + '.codes'), 'i'):
+            yield values[code]
+
+    def rows(self):
+        """
+        Yield the rows of the table as mappings of column names to
+        string values, decoding one row at a time.
+        """
+        columns = [self.values(name) for name in self.fields]
+        for values in zip(*columns):
+            yield dict(zip(self.fields, values))
+
+
+class _ColumnBuilder(object):
+    def __init__(self):
+        self.ints = array('q')
+        self.codes = array('i')
+        self.values = {}
+        self.is_int = True
+
+    def add(self, value):
+        if self.is_int:
+            try:
+                x = int(value)
+            except ValueError:
+                x = None
+            # only values that convert back to the same string
+            if x is not None and str(x) == value and -2**63 <= x < 2**63:
+                self.ints.append(x)
+            else:
+                self.is_int = False
+                for x in self.ints:
+                    self._add_string(str(x))
+                self.ints = None
+                self._add_string(value)
+        else:
+            self._add_string(value)
+
+    def _add_string(self, value):
+        code = self.values.setdefault(value, len(self.values))
+        self.codes.append(code)
+
+    def write(self, path, name):
+        if self.is_int:
+            with open(os.path.join(path, name + '.int'), 'wb') as fh:
+                self.ints.tofile(fh)
+            return 'int'
+        offsets = array('q', [0])
+        with open(os.path.join(path, name + '.dict'), 'wb') as fh:
+            for value in self.values:  # in order of their codes
+                data = value.encode('utf-8')
+                fh.write(data)
+                offsets.append(offsets[-1] + len(data))
+        with open(os.path.join(path, name + '.offsets'), 'wb') as fh:
+            offsets.tofile(fh)
+        with open(os.path.join(path, name + '.codes'), 'wb') as fh:
+            self.codes.tofile(fh)
+        return 'dict'
+
+
+def _map_array(path, typecode):
+    if os.path.getsize(path) == 0:
+        return array(typecode)  # empty files cannot be mapped
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm).cast(typecode)
+
+
+class _Dictionary(object):
+    # the values of a dictionary-encoded column, decoded on access
+    def __init__(self, path, name):
+        self.offsets = _map_array(os.path.join(path, name + '.offsets'), 'q')
+        self.data = _map_array(os.path.join(path, name + '.dict'), 'B')
+
+    def __getitem__(self, code):
+        start, end = self.offsets[code], self.offsets[code + 1]
+        return bytes(self.data[start:end]).decode('utf-8')
+
+
+def _read_dictionary(path, name):
+    offsets = array('q')
+    with open(os.path.join(path, name + '.offsets'), 'rb') as fh:
+        offsets.frombytes(fh.read())
+    with open(os.path.join(path, name + '.dict'), 'rb') as fh:
+        data = fh.read()
+    return [data[offsets[i]:offsets[i+1]].decode('utf-8')
+            for i in range(len(offsets) - 1)]
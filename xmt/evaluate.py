@@ -1,18 +1,44 @@
 
 import os
 from itertools import groupby
+from functools import partial
+from contextlib import ExitStack
+from array import array
+import heapq
+import pickle
+import re
 import logging
 
-from nltk.translate import bleu_score
-from nltk.tokenize.toktok import ToktokTokenizer
-
 from delphin import itsdb
-from delphin.exceptions import ItsdbError
 
-from xmt import select
+from xmt import select, snapshot, metrics, tokens, util, phases
+from xmt.stats import percentile
+
+_bleu_keys = ('bleu', 'oracle-bleu', 'rephrase-bleu', 'rephrase-oracle-bleu')
+# statistics that are combined with + rather than summed as counts
+_merged_keys = _bleu_keys + ('timing',)
 
-_tokenize = ToktokTokenizer().tokenize
-_smoother = bleu_score.SmoothingFunction().method3
+# evaluation results are cached in each profile; bump the version when
+# the contents of the statistics change
+_CACHE_FILE = 'evaluation.pickle'
+_CACHE_VERSION = 3
+_cached_tables = ('item', 'p-info', 'p-result', 'x-info', 'x-result',
+                  'g-info', 'g-result', 'r-info', 'r-result')
+
+# (task, info table, id columns) of each processing stage
+_stages = (
+    ('parse', 'p-info', ('i-id',)),
+    ('transfer', 'x-info', ('i-id', 'p-id')),
+    ('generate', 'g-info', ('i-id', 'p-id', 'x-id')),
+    ('rephrase', 'r-info', ('i-id', 'p-id')),
+)
+# errors of inputs that ran out of time in ACE or the watchdog
+_timeout_re = re.compile(r'time(d)?[ -]?out|killed after', re.I)
+# errors of inputs left out by the --budget-* task options
+_skipped_re = re.compile(r'^skipped: over budget')
+# width and number of the i-length buckets in timing breakdowns
+_LENGTH_BUCKET = 5
+_LENGTH_BUCKETS = 8
 
 
 def do(args):
@@ -24,32 +50,17 @@ def do(args):
 
     numitems = len(args['ITEM'])
     width = len(str(numitems))
+    processes = int(args.get('--profiles-parallel') or 1)
     stats = {}
 
-    for i, itemdir in enumerate(args['ITEM']):
-        itemdir = os.path.normpath(itemdir)
+    results = util.map_items(
+        partial(_evaluate_item, args), args['ITEM'], processes=processes
+    )
+    for i, (itemdir, p_stats) in enumerate(results):
         logging.info(
-            'Evaluate {0:{1}d}/{2} {3}'
+            'Evaluated {0:{1}d}/{2} {3}'
             .format(i+1, width, numitems, itemdir)
         )
-        p = itsdb.ItsdbProfile(itemdir)
-        p_stats = {}
-        if args['--coverage']:
-            update_stats(p_stats, coverage(p, args['--ignore']))
-
-        if args['--bleu'] and p.size('g-result') > 0:
-            update_stats(p_stats, bleu(p, 'realizations'))
-        if args['--bleu'] and p.size('r-result') > 0:
-            update_stats(p_stats, bleu(p, 'rephrases'))
-
-        if args['--oracle-bleu'] and p.size('g-result') > 0:
-            update_stats(p_stats, oracle_bleu(p, 'realizations'))
-        if args['--oracle-bleu'] and p.size('r-result') > 0:
-            update_stats(p_stats, oracle_bleu(p, 'rephrases'))
-
-        # if args['--meteor']:
-        #     update_stats(p_stats, meteor(p))
-
         if not args['--summary-only']:
             print(format_eval(itemdir, p_stats, args))
 
@@ -59,93 +70,344 @@ def do(args):
         print(format_eval('Summary', stats, args))
 
 
-def coverage(p, ignore=None):
-    logging.debug('Calculating coverage for {}'.format(p.root))
-    p_results = rows(p, 'p-result')
-    x_results = rows(p, 'x-result')
-    g_results = rows(p, 'g-result')
-    r_results = rows(p, 'r-result')
-    cov = {'items': len(list(p.read_table('item')))}
-    if p_results:
-        cov['items-parsed'] = len(set(r['i-id'] for r in p_results))
+def _evaluate_item(args, i, itemdir):
+    numitems = len(args['ITEM'])
+    width = len(str(numitems))
+    itemdir = os.path.normpath(itemdir)
+    logging.info(
+        'Evaluate {0:{1}d}/{2} {3}'
+        .format(i+1, width, numitems, itemdir)
+    )
+    p = itsdb.ItsdbProfile(itemdir)
+    key = _cache_key(args)
+    p_stats = None
+    if not args.get('--recompute'):
+        with phases.phase('table read'):
+            p_stats = _cached_stats(p, key)
+    if p_stats is None:
+        # tables are read and strings tokenized as the metrics need
+        # them, and those phases are timed separately
+        with phases.phase('scoring'):
+            p_stats = _compute_stats(p, args)
+        with phases.phase('table write'):
+            _store_stats(p, key, p_stats)
+    else:
+        logging.debug('Using cached evaluation of {}'.format(itemdir))
+    return itemdir, p_stats
+
+
+def _compute_stats(p, args):
+    snap = snapshot.ProfileSnapshot(p, ignore=args['--ignore'])
+    p_stats = {}
+    if args['--coverage']:
+        update_stats(p_stats, coverage(snap))
+
+    with ExitStack() as stack:
+        if args.get('--token-cache'):
+            stack.enter_context(tokens.profile_cache(p))
+        if args['--bleu'] and len(snap.table('g-result')) > 0:
+            update_stats(p_stats, bleu(snap, 'realizations'))
+        if args['--bleu'] and len(snap.table('r-result')) > 0:
+            update_stats(p_stats, bleu(snap, 'rephrases'))
+
+        if args['--oracle-bleu'] and len(snap.table('g-result')) > 0:
+            update_stats(p_stats, oracle_bleu(snap, 'realizations'))
+        if args['--oracle-bleu'] and len(snap.table('r-result')) > 0:
+            update_stats(p_stats, oracle_bleu(snap, 'rephrases'))
+
+    if args.get('--timing'):
+        update_stats(p_stats, timing(snap, int(args['--slowest'] or 10)))
+
+    # if args['--meteor']:
+    #     update_stats(p_stats, meteor(p))
+
+    return p_stats
+
+
+def _cache_key(args):
+    return (_CACHE_VERSION, args['--ignore'],
+            bool(args['--coverage']), bool(args['--bleu']),
+            bool(args['--oracle-bleu']), bool(args.get('--timing')),
+            args.get('--slowest'))
+
+
+def _cached_stats(p, key):
+    """
+    Return the statistics cached in *p* for the options *key* if the
+    tables they were computed from have not changed, otherwise `None`.
+
+    Tables whose size is the same but whose modification time is not
+    are compared by their digests.
+    """
+    entries = _read_cache(p)
+    if key not in entries:
+        return None
+    tables, p_stats = entries[key]
+    current = util.table_fingerprint(p.root, _cached_tables)
+    if [fp[:3] for fp in tables] == current:
+        return p_stats
+    if [fp[:2] for fp in tables] != [fp[:2] for fp in current]:
+        return None
+    for (filename, _, mtime, digest), fp in zip(tables, current):
+        if (mtime != fp[2] and
+                util.file_digest(os.path.join(p.root, filename)) != digest):
+            return None
+    _store_stats(p, key, p_stats)  # remember the new modification times
+    return p_stats
+
+
+def _store_stats(p, key, p_stats):
+    entries = _read_cache(p)
+    tables = [
+        fp + [util.file_digest(os.path.join(p.root, fp[0]))]
+        for fp in util.table_fingerprint(p.root, _cached_tables)
+    ]
+    entries[key] = (tables, p_stats)
+    path = os.path.join(p.root, _CACHE_FILE)
+    try:
+        with open(path + '.tmp', 'wb') as fh:
+            pickle.dump(entries, fh)
+        os.replace(path + '.tmp', path)
+    except OSError as ex:
+        logging.debug('Could not cache evaluation of {}: {}'
+                      .format(p.root, ex))
+
+
+def _read_cache(p):
+    path = os.path.join(p.root, _CACHE_FILE)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError):
+        logging.warning('Ignoring unreadable evaluation cache {}'
+                        .format(path))
+        return {}
+
+
+def coverage(snap):
+    logging.debug('Calculating coverage for {}'.format(snap.root))
+    p_results = snap.table('p-result')
+    x_results = snap.table('x-result')
+    g_results = snap.table('g-result')
+    r_results = snap.table('r-result')
+    cov = {'items': len(snap.table('item'))}
+    if len(p_results):
+        cov['items-parsed'] = p_results.distinct('i-id')
         cov['parses'] = len(p_results)
-    if x_results:
-        if ignore is not None:
-            x_results = [r for r in x_results if ignore not in r['mrs']]
-        cov['items-transferred'] = len(set(r['i-id'] for r in x_results))
-        cov['parses-transferred'] = len(set((r['i-id'], r['p-id'])
-                                        for r in x_results))
+    if len(x_results):
+        cov['items-transferred'] = x_results.distinct('i-id')
+        cov['parses-transferred'] = x_results.distinct('i-id', 'p-id')
         cov['transfers'] = len(x_results)
-    if g_results:
-        cov['items-realized'] = len(set(r['i-id'] for r in g_results))
-        cov['transfers-realized'] = len(set((r['i-id'], r['p-id'], r['x-id'])
-                                            for r in g_results))
+    if len(g_results):
+        cov['items-realized'] = g_results.distinct('i-id')
+        cov['transfers-realized'] = g_results.distinct('i-id', 'p-id',
+                                                       'x-id')
         cov['realizations'] = len(g_results)
-    if r_results:
-        cov['items-rephrased'] = len(set(r['i-id'] for r in r_results))
-        cov['parses-rephrased'] = len(set((r['i-id'], r['p-id'])
-                                          for r in r_results))
+    if len(r_results):
+        cov['items-rephrased'] = r_results.distinct('i-id')
+        cov['parses-rephrased'] = r_results.distinct('i-id', 'p-id')
         cov['rephrases'] = len(r_results)
     return cov
 
-def rows(p, tablename):
-    try:
-        return list(p.read_table(tablename))
-    except (KeyError, ItsdbError):
-        return []
-
-def bleu(p, task):
+def bleu(snap, task):
     if task == 'realizations':
         join_table = 'g-result'
-        hyp_spec = 'g-result:surface'
-        ref_spec = 'item:i-translation'
+        ref_col = 'i-translation'
         key = 'bleu'
     elif task == 'rephrases':
         join_table = 'r-result'
-        hyp_spec = 'r-result:surface'
-        ref_spec = 'item:i-input'
+        ref_col = 'i-input'
         key = 'rephrase-bleu'
 
-    logging.debug('Calculating BLEU for {}'.format(p.root))
-    pairs = select.select_first(p, join_table, hyp_spec, ref_spec)
-
-    score = bleu_score.corpus_bleu(
-        [[_tokenize(ref.lower())] for _, ref in pairs],
-        [_tokenize(hyp.lower()) for hyp, _ in pairs],
-        smoothing_function=_smoother
+    logging.debug('Calculating BLEU for {}'.format(snap.root))
+    pairs = select.first_pairs(
+        snap.candidates(join_table, 'surface', ref_col)
     )
-    return {key: [score]}
 
-def oracle_bleu(p, task):
+    return {key: metrics.bleu_stats(pairs)}
+
+def oracle_bleu(snap, task):
     if task == 'realizations':
         join_table = 'g-result'
-        hyp_spec = 'g-result:surface'
-        ref_spec = 'item:i-translation'
+        ref_col = 'i-translation'
         key = 'oracle-bleu'
     elif task == 'rephrases':
         join_table = 'r-result'
-        hyp_spec = 'r-result:surface'
-        ref_spec = 'item:i-input'
+        ref_col = 'i-input'
         key = 'rephrase-oracle-bleu'
 
-    logging.debug('Calculating Oracle-BLEU for {}'.format(p.root))
-    pairs = select.select_oracle(p, join_table, hyp_spec, ref_spec)
-    score = bleu_score.corpus_bleu(
-        [[_tokenize(ref.lower())] for _, ref in pairs],
-        [_tokenize(hyp.lower()) for hyp, _ in pairs],
-        smoothing_function=_smoother
+    logging.debug('Calculating Oracle-BLEU for {}'.format(snap.root))
+    pairs = select.oracle_pairs(
+        snap.candidates(join_table, 'surface', ref_col)
     )
-    return {key: [score]}
+    return {key: metrics.bleu_stats(pairs)}
+
+
+def timing(snap, slowest=10):
+    logging.debug('Calculating timing for {}'.format(snap.root))
+    items = snap.table('item')
+    lengths = dict(zip(items['i-id'], items['i-length']))
+    inputs = dict(zip(items['i-id'], items['i-input']))
+    ts = TimingStats(slowest)
+    for task, table, id_cols in _stages:
+        info = snap.table(table)
+        ids = zip(*[info[col] for col in id_cols])
+        for source, t, mem, err in zip(ids, info['time'], info['memory'],
+                                       info['error']):
+            i_id = source[0]
+            ts.add(task, t, mem, err, lengths.get(i_id, -1),
+                   (snap.root, '|'.join(map(str, source)),
+                    inputs.get(i_id, '')))
+    return {'timing': ts}
+
+
+class TimingStats(object):
+    """
+    Processing times and memory use of the inputs of each task, as
+    recorded in the *-info tables.
+
+    Statistics of several profiles are combined with `+`. Only the
+    *slowest* inputs over all tasks are kept individually.
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.tasks = {}
+        self.top = []  # heap of (time, task, (profile, ids, input))
+
+    def __add__(self, other):
+        ts = TimingStats(max(self.slowest, other.slowest))
+        for task in set(self.tasks).union(other.tasks):
+            a = self.tasks.get(task) or _new_timing()
+            b = other.tasks.get(task) or _new_timing()
+            ts.tasks[task] = {
+                'inputs': a['inputs'] + b['inputs'],
+                'errors': a['errors'] + b['errors'],
+                'timeouts': a['timeouts'] + b['timeouts'],
+                'skipped': a['skipped'] + b['skipped'],
+                'memory': max(a['memory'], b['memory']),
+                'times': a['times'] + b['times'],
+                'lengths': a['lengths'] + b['lengths'],
+            }
+        for entry in self.top + other.top:
+            ts._keep(entry)
+        return ts
+
+    def add(self, task, time, memory, error, length, where):
+        """
+        Add an input of *task* that took *time* milliseconds and
+        *memory* bytes (-1 if unknown), had *error* (possibly empty),
+        and came from an item of *length* tokens. The *where* triple
+        of (profile, ids, input) identifies the input.
+        """
+        st = self.tasks.setdefault(task, _new_timing())
+        if error and _skipped_re.match(error):
+            st['skipped'] += 1
+            return
+        st['inputs'] += 1
+        if error:
+            st['errors'] += 1
+            if _timeout_re.search(error):
+                st['timeouts'] += 1
+        st['memory'] = max(st['memory'], memory)
+        if time >= 0:
+            st['times'].append(time)
+            st['lengths'].append(length)
+            self._keep((time, task, where))
+
+    def _keep(self, entry):
+        if len(self.top) < self.slowest:
+            heapq.heappush(self.top, entry)
+        elif entry > self.top[0]:
+            heapq.heapreplace(self.top, entry)
+
+
+def _new_timing():
+    return {'inputs': 0, 'errors': 0, 'timeouts': 0, 'skipped': 0,
+            'memory': -1,
+            'times': array('q'), 'lengths': array('q')}
+
+
+def format_timing(ts):
+    s = '  Timing:\n'
+    for task, _, _ in _stages:
+        if task not in ts.tasks:
+            continue
+        st = ts.tasks[task]
+        times = st['times']
+        total = sum(times) / 1000.0
+        s += (
+            '    {task:<10} {inputs} inputs in {total:0.2f}s '
+            '({rate:0.2f} inputs/s), {errors} errors, {timeouts} timeouts'
+            '{skipped}\n'
+            '      Time (ms):             p50 {t50:>7} p95 {t95:>7} '
+            'p99 {t99:>7} max {tmax:>7}\n'
+            '      Peak memory:           {memory}\n'
+        ).format(
+            task=task + ':',
+            inputs=st['inputs'],
+            total=total,
+            rate=len(times) / (total or 1.0),
+            errors=st['errors'],
+            timeouts=st['timeouts'],
+            skipped=(', {} skipped'.format(st['skipped'])
+                     if st['skipped'] else ''),
+            t50=percentile(times, 50),
+            t95=percentile(times, 95),
+            t99=percentile(times, 99),
+            tmax=max(times, default=0),
+            memory=('{:0.1f} MB'.format(st['memory'] / (1024.0 * 1024))
+                    if st['memory'] >= 0 else 'unknown'),
+        )
+        buckets = {}
+        for t, length in zip(times, st['lengths']):
+            buckets.setdefault(_length_bucket(length), []).append(t)
+        if buckets:
+            s += '      By i-length (ms):\n'
+        for bucket in sorted(buckets):
+            bt = buckets[bucket]
+            s += (
+                '        {label:<7} {n:>7} inputs, mean {mean:>7.0f} '
+                'p95 {p95:>7}\n'
+            ).format(
+                label=_length_label(bucket),
+                n=len(bt),
+                mean=sum(bt) / float(len(bt)),
+                p95=percentile(bt, 95)
+            )
+    if ts.top:
+        s += '  Slowest inputs (ms):\n'
+        for time, task, (profile, ids, inp) in sorted(ts.top, reverse=True):
+            s += '    {:>8} {:<9} {} {}  {}\n'.format(
+                time, task, profile, ids, inp
+            )
+    return s
+
+
+def _length_bucket(length):
+    if length < 0:
+        return -1
+    return min((max(length, 1) - 1) // _LENGTH_BUCKET, _LENGTH_BUCKETS)
+
+
+def _length_label(bucket):
+    if bucket < 0:
+        return '?'
+    elif bucket == _LENGTH_BUCKETS:
+        return '{}+'.format(bucket * _LENGTH_BUCKET + 1)
+    return '{}-{}'.format(bucket * _LENGTH_BUCKET + 1,
+                          (bucket + 1) * _LENGTH_BUCKET)
 
 
 # def meteor(p):
 #     return {}
 
 def format_eval(name, stats, args):
-    w = max(len(str(v)) for k, v in stats.items()
-            if k not in ('bleu', 'oracle-bleu', 'rephrase-bleu',
-                         'rephrase-oracle-bleu'))
-    avg_label=' (average):' if len(args['ITEM']) > 1 else ':' + (' ' * 10)
+    w = max((len(str(v)) for k, v in stats.items()
+             if k not in _merged_keys), default=1)
 
     s = '{name}:\n'.format(name=name)
     
@@ -209,15 +471,12 @@ def format_eval(name, stats, args):
                 gd=stats['realizations']/float(stats['transfers-realized']),
             )
             if args['--bleu']:
-                s +='    BLEU{avg_label}          {bleu:4.2f}\n'.format(
-                    avg_label=avg_label,
-                    bleu=(sum(stats['bleu']) / len(stats['bleu'])) * 100
+                s +='    BLEU:                    {bleu:4.2f}\n'.format(
+                    bleu=stats['bleu'].score() * 100
                 )
             if args['--oracle-bleu']:
-                s +='    Oracle BLEU{avg_label}   {oracle:4.2f}\n'.format(
-                    avg_label=avg_label,
-                    oracle=(sum(stats['oracle-bleu']) /
-                            len(stats['oracle-bleu'])) * 100
+                s +='    Oracle BLEU:             {oracle:4.2f}\n'.format(
+                    oracle=stats['oracle-bleu'].score() * 100
                 )
 
         if 'rephrases' in stats:
@@ -241,24 +500,23 @@ def format_eval(name, stats, args):
                 rd=stats['rephrases']/float(stats['parses-rephrased'])
             )
             if args['--bleu']:
-                s +='    BLEU{avg_label}          {bleu:4.2f}\n'.format(
-                    avg_label=avg_label,
-                    bleu=(sum(stats['rephrase-bleu']) /
-                          len(stats['rephrase-bleu'])) * 100
+                s +='    BLEU:                    {bleu:4.2f}\n'.format(
+                    bleu=stats['rephrase-bleu'].score() * 100
                 )
             if args['--oracle-bleu']:
-                s +='    Oracle BLEU{avg_label}   {oracle:4.2f}\n'.format(
-                    avg_label=avg_label,
-                    oracle=(sum(stats['rephrase-oracle-bleu']) /
-                            len(stats['rephrase-oracle-bleu'])) * 100
+                s +='    Oracle BLEU:             {oracle:4.2f}\n'.format(
+                    oracle=stats['rephrase-oracle-bleu'].score() * 100
                 )
+
+    if args.get('--timing') and 'timing' in stats:
+        s += format_timing(stats['timing'])
     return s
 
 
 def update_stats(stats, prof_stats):
     for key, val in prof_stats.items():
-        if key in ('bleu', 'oracle-bleu',
-                   'rephrase-bleu', 'rephrase-oracle-bleu'):
-            stats[key] = stats.get(key, []) + val
+        if key in _merged_keys:
+            # e.g., BLEU statistics combine into a corpus-level score
+            stats[key] = stats[key] + val if key in stats else val
         else:
             stats[key] = stats.get(key, 0) + val
@@ -4,17 +4,35 @@ USAGE="""
 XMT
 
 usage:
-  xmt init      [-v...] [--parse=OPTS] [--transfer=OPTS] [--generate=OPTS]
-                [--rephrase=OPTS] [--full] [--reverse] [--ace-bin=PATH]
-                DIR [ITEM...]
-  xmt parse     [-v...] [ITEM...]
-  xmt transfer  [-v...] [ITEM...]
-  xmt generate  [-v...] [ITEM...]
-  xmt rephrase  [-v...] [ITEM...]
+  xmt init      [-v...] [--profile=PATH] [--parse=OPTS] [--transfer=OPTS]
+                [--generate=OPTS] [--rephrase=OPTS] [--full] [--reverse]
+                [--ace-bin=PATH] [--cache=PATH] [--profiles-parallel=N]
+                [--shard-size=N] DIR [ITEM...]
+  xmt parse     [-v...] [--profile=PATH] [--jobs=N] [--profiles-parallel=N]
+                [--resume] [--schedule] [ITEM...]
+  xmt transfer  [-v...] [--profile=PATH] [--jobs=N] [--profiles-parallel=N]
+                [--resume] [--schedule] [--budget-results=K]
+                [--budget-seconds=S] [ITEM...]
+  xmt generate  [-v...] [--profile=PATH] [--jobs=N] [--profiles-parallel=N]
+                [--resume] [--schedule] [--budget-results=K]
+                [--budget-seconds=S] [ITEM...]
+  xmt rephrase  [-v...] [--profile=PATH] [--jobs=N] [--profiles-parallel=N]
+                [--resume] [--schedule] [--budget-results=K]
+                [--budget-seconds=S] [ITEM...]
+  xmt translate [-v...] [--profile=PATH] [--jobs=N] [--profiles-parallel=N]
+                [ITEM...]
+  xmt run       [-v...] [--profile=PATH] [--tasks=LIST] [--jobs=N]
+                [--workers=N] [--force] [--dry-run] [ITEM...]
   xmt evaluate  [--coverage] [--bleu] [--oracle-bleu] [--all] [--ignore=S]
-                [--summary-only] [-v...] [ITEM...]
+                [--summary-only] [--profiles-parallel=N] [--token-cache]
+                [--recompute] [--timing [--slowest=K]] [-v...]
+                [--profile=PATH] [ITEM...]
   xmt select    [--oracle-bleu] [--tokenize] [--rephrasing] [--item-id]
-                [-v...] [ITEM...]
+                [--jobs=N] [--token-cache] [-v...] [--profile=PATH] [ITEM...]
+  xmt stats     [--run=N] [--summary-only] [-v...] [--profile=PATH] [ITEM...]
+  xmt merge     [-v...] [--profile=PATH] PROFILE ITEM...
+  xmt pack      [-v...] [--profile=PATH] [ITEM...]
+  xmt unpack    [-v...] [--profile=PATH] [ITEM...]
   xmt [--help|--version]
 
 Tasks:
@@ -23,17 +41,30 @@ Tasks:
   transfer                  transfer source to target semantics
   generate                  realize strings from target semantics
   rephrase                  realize strings from source semantics
+  translate                 parse, transfer, and generate in one pipeline
+  run                       run the tasks whose inputs or settings changed
   evaluate                  evaluate results of other tasks
   select                    print translation/realization pairs
+  stats                     report throughput statistics of task runs
+  merge                     combine the tables of profiles (e.g., shards)
+  pack                      store result tables in the columnar format
+  unpack                    restore result tables to the tsdb format
 
 Arguments:
   DIR                       workspace directory
+  PROFILE                   profile to create
   ITEM                      profile to process
 
 Options:
   -h, --help                print usage and exit
   -V, --version             print version and exit
-  -v, --verbose             increase logging verbosity (may be repeated)
+  -v, --verbose             increase logging verbosity (may be repeated);
+                            with -vv, the time spent in each phase (e.g.,
+                            table reads or waiting for ACE) is reported
+  --profile PATH            write cProfile statistics of the command to
+                            PATH, or to a file in PATH if it is a directory;
+                            each worker process (e.g., with -P) writes its
+                            own file next to it
   --parse OPTS              configure parsing with OPTS
   --transfer OPTS           configure transfer with OPTS
   --generate OPTS           configure generation with OPTS
@@ -41,19 +72,57 @@ Options:
   --full                    import full profiles, not just item info
   --reverse                 switch input and translation sentences
   --ace-bin PATH            path to ace binary [default=ace]
+  --cache PATH              cache ACE responses in the database at PATH
+  --shard-size N            split each ITEM into profiles of N items
+
+Task Options:
+  -j N, --jobs N            run N ACE processes per profile (for select,
+                            score oracle candidates in N processes)
+                            [default: 1]
+  -P N, --profiles-parallel N
+                            process N profiles concurrently [default: 1]
+  --resume                  only process inputs without results from a
+                            previous (interrupted or failed) run
+  --schedule                process inputs in order of decreasing expected
+                            time, estimated from input size and previous runs
+                            (results are still written in input order)
+  --budget-results K        process the inputs of each item best-first, by
+                            the product of their upstream scores, and skip
+                            the rest once they gave K results
+  --budget-seconds S        likewise, but once they took S seconds in ACE;
+                            skipped inputs are processed with --resume
+
+Run Options:
+  --tasks LIST              comma-separated tasks to bring up to date, with
+                            the tasks they depend on
+                            [default: parse,transfer,generate,rephrase]
+  --workers N               run N tasks (on any profiles) at once
+                            [default: 2]
+  --force                   run the tasks even if they are up to date
+  --dry-run                 only list the profiles and tasks to run
 
 Evaluation Options:
-  --coverage
-  --bleu
-  --oracle-bleu
-  --all
-  --ignore S
-  --summary-only
+  --coverage                report coverage of each task
+  --bleu                    report BLEU of the first realizations
+  --oracle-bleu             report BLEU of the best realizations
+  --all                     report all of the above
+  --timing                  report processing time and memory of each task
+  --slowest K               list the K slowest inputs with --timing
+                            [default: 10]
+  --ignore S                ignore transfer results with S in the MRS
+  --summary-only            only report the summary of all profiles
+  --token-cache             save tokenized strings in each profile for
+                            later evaluations
+  --recompute               do not use evaluation results cached in the
+                            profiles (they are still updated)
+
+Statistics Options:
+  --run N                   report on run N instead of the latest run
 
 """
 
 OPTS_USAGE="""
-Usage: task -g PATH [-n N] [-y] [--timeout S]
+Usage: task -g PATH [-n N] [-y] [--timeout S] [--watchdog-timeout S]
             [--max-chart-megabytes=M] [--max-unpack-megabytes=M]
             [--only-subsuming]
 
@@ -62,6 +131,8 @@ Options:
   -n N                      only record the top N results [default=5]
   -y                        use yy mode on input
   --timeout S               allow S seconds per item [default=60]
+  --watchdog-timeout S      kill and restart ACE if it does not respond
+                            within S seconds (0 to disable) [default=300]
   --max-chart-megabytes M   max RAM for parse chart in MB [default=1200]
   --max-unpack-megabytes M  max RAM for unpacking in MB [default=1500]
   --only-subsuming          realization MRS must subsume input MRS
@@ -71,16 +142,18 @@ Options:
 import os
 import re
 import shlex
+import shutil
 from glob import glob
 import json
 import logging
+from functools import partial
 from configparser import ConfigParser
 
 from docopt import docopt
 
 from delphin import itsdb
 
-from xmt import task, select, evaluate, util
+from xmt import util, tables, phases, profiling
 
 __version__ = '0.2.0'
 
@@ -90,10 +163,15 @@ default_config = {
         'num-results': 5,
         'timeout': 60,
         'result-buffer-size': 1000,
+        'flush-kilobytes': 1024,
+        'flush-seconds': 60,
+        'schedule-window': 100,
         'max-chart-megabytes': 1200,
         'max-unpack-megabytes': 1500,
         'only-subsuming': 'no',
         'yy-mode': 'no',
+        'cache-megabytes': 1024,
+        'watchdog-timeout': 300,
     },
     'parse': {},
     'transfer': {},
@@ -113,6 +191,7 @@ p-info:
   i-id :integer :key                    # item parsed
   time :integer                         # processing time (msec)
   memory :integer                       # bytes of memory allocated
+  error :string                         # error message, if any
 
 p-result:
   i-id :integer :key                    # item parsed
@@ -126,6 +205,7 @@ x-info:
   p-id :integer :key                    # parse result id
   time :integer                         # processing time (msec)
   memory :integer                       # bytes of memory allocated
+  error :string                         # error message, if any
 
 x-result:
   i-id :integer :key                    # item parsed
@@ -140,6 +220,7 @@ g-info:
   x-id :integer :key                    # transfer result id
   time :integer                         # processing time (msec)
   memory :integer                       # bytes of memory allocated
+  error :string                         # error message, if any
 
 g-result:
   i-id :integer :key                    # item parsed
@@ -155,6 +236,7 @@ r-info:
   p-id :integer :key                    # parse result id
   time :integer                         # processing time (msec)
   memory :integer                       # bytes of memory allocated
+  error :string                         # error message, if any
 
 r-result:
   i-id :integer :key                    # item parsed
@@ -164,6 +246,29 @@ r-result:
   mrs :string                           # specified mrs used in realization
   score :float                          # parse reranker score
 
+run-stats:
+  run :integer :key                     # run number
+  task :string :key                     # task name
+  start :string                         # start time
+  jobs :integer                         # ACE processes
+  wall :integer                         # wall time of the task (msec)
+  inputs :integer                       # inputs processed
+  results :integer                      # results written
+  bytes :integer                        # bytes of rows written
+  ace :integer                          # time interacting with ACE (msec)
+  convert :integer                      # time converting responses (msec)
+  write :integer                        # time writing rows (msec)
+
+item-stats:
+  run :integer :key                     # run number
+  task :string :key                     # task name
+  source :string                        # ids of the input (e.g., 10|0)
+  queue :integer                        # time waiting for ACE (msec)
+  wall :integer                         # time interacting with ACE (msec)
+  cpu :integer                          # processing time from ACE (msec)
+  results :integer                      # results written
+  bytes :integer                        # bytes of rows written
+
 '''
 
 
@@ -175,22 +280,73 @@ def main():
     )
     logging.basicConfig(level=50 - ((args['--verbose'] + 2) * 10))
 
-    args['ITEM'] = [i for pattern in args['ITEM'] for i in glob(pattern)]
+    # sorted, so numbered profiles such as shards are in order
+    args['ITEM'] = [i for pattern in args['ITEM']
+                    for i in sorted(glob(pattern), key=_natural_key)]
+
+    if args['--profile']:
+        profiling.start(args['--profile'], _command(args))
+    try:
+        _run_command(args)
+    finally:
+        if args['--profile']:
+            path = profiling.stop()
+            if path is not None:
+                logging.info('Wrote profile statistics to {}'.format(path))
+        phases.report()
+
+
+def _natural_key(path):
+    # compare runs of digits as numbers, so shard1000 follows shard999
+    return [(int(part), '') if part.isdigit() else (-1, part)
+            for part in re.split(r'(\d+)', path)]
+
 
+def _command(args):
+    commands = ('init', 'parse', 'transfer', 'generate', 'rephrase',
+                'translate', 'run', 'evaluate', 'select', 'stats', 'merge',
+                'pack', 'unpack')
+    return next(cmd for cmd in commands if args[cmd])
+
+
+def _run_command(args):
+    # subcommand modules are imported when used, so a command does not
+    # pay for loading the dependencies of the others
     if args['init']:
         init(args)
     elif args['parse']:
+        from xmt import task
         task.do('parse', args)
     elif args['transfer']:
+        from xmt import task
         task.do('transfer', args)
     elif args['generate']:
+        from xmt import task
         task.do('generate', args)
     elif args['rephrase']:
+        from xmt import task
         task.do('rephrase', args)
+    elif args['translate']:
+        from xmt import task
+        task.translate(args)
+    elif args['run']:
+        from xmt import run
+        run.do(args)
     elif args['evaluate']:
+        from xmt import evaluate
         evaluate.do(args)
     elif args['select']:
+        from xmt import select
         select.do(args)
+    elif args['stats']:
+        from xmt import stats
+        stats.do(args)
+    elif args['merge']:
+        from xmt import merge
+        merge.do(args)
+    elif args['pack'] or args['unpack']:
+        from xmt import columnar
+        columnar.do(args)
 
 def init(args):
     d = args['DIR']
@@ -213,90 +369,235 @@ def init(args):
     if 'grammar' not in config['rephrase'] and 'grammar' in config['parse']:
         config['rephrase']['grammar'] = config['parse']['grammar']
 
+    shard_size = int(args.get('--shard-size') or 0)
+    items = []
     for item in args['ITEM']:
         item = os.path.normpath(item)
-        rows = item_rows(item, args['--reverse'])
+        if args['--full'] and not os.path.isdir(item):
+            raise ValueError('Only profiles allowed with --full: ' + str(item))
+        # directories are created here so concurrent imports of items
+        # with the same basename get distinct names; for sharded items
+        # the first shard reserves the name
         itemdir = _unique_pathname(d, os.path.basename(item))
-        os.makedirs(itemdir)
-        with open(os.path.join(itemdir, 'relations'), 'w') as fh:
-            print(relations_string, file=fh)
-        p = itsdb.ItsdbProfile(itemdir)
-        p.write_table('item', rows, gzip=True)
-        if args['--full']:
-            info, results = _parse_tables(item)
-            p.write_table('p-info', info, gzip=True)
-            p.write_table('p-result', results, gzip=True)
+        if shard_size:
+            _make_profile_dir(shard_dir(itemdir, 1))
+        else:
+            _make_profile_dir(itemdir)
+        items.append((item, itemdir))
+
+    processes = int(args.get('--profiles-parallel') or 1)
+    import_item = partial(
+        _import_item, args['--reverse'], args['--full'], shard_size
+    )
+    try:
+        for itemdirs in util.map_items(import_item, items,
+                                       processes=processes):
+            for itemdir in itemdirs:
+                logging.info('Imported {}'.format(itemdir))
+    except BaseException:
+        # the directories reserved for items whose import did not
+        # start are removed; failed imports remove their own
+        for _, itemdir in items:
+            first = shard_dir(itemdir, 1) if shard_size else itemdir
+            if not any(os.path.exists(os.path.join(first, fn))
+                       for fn in ('item', 'item.gz')):
+                _remove_profiles(itemdir, shard_size)
+        raise
 
     with open(os.path.join(d, 'default.conf'), 'w') as fh:
         config.write(fh)
 
 
+def _import_item(reverse, full, shard_size, i, item):
+    """
+    Import *item*, a pair of a source item and the new profile's
+    directory, and return the list of profiles created. Rows are
+    streamed from the source to the new tables, so memory use does
+    not grow with the size of the item.
+    """
+    item, itemdir = item
+    try:
+        if shard_size:
+            return _import_shards(item, itemdir, reverse, full, shard_size)
+        p = itsdb.ItsdbProfile(itemdir)
+        _write_rows(p, 'item', item_rows(item, reverse))
+        if full:
+            _write_rows(p, 'p-info', _parse_info_rows(item))
+            _write_rows(p, 'p-result', _parse_result_rows(item))
+        return [itemdir]
+    except BaseException:
+        # a partial profile would take the item's name and be picked
+        # up by later commands
+        _remove_profiles(itemdir, shard_size)
+        raise
+
+
+def _import_shards(item, itemdir, reverse, full, shard_size):
+    """
+    Import *item* into profiles of at most *shard_size* items each
+    (see shard_dir()). Parse rows go to the shard of their item.
+    """
+    shards = []
+    shard_of = {}
+    writer = None
+    try:
+        for n, row in enumerate(item_rows(item, reverse)):
+            if n % shard_size == 0:
+                if writer is not None:
+                    writer.close()
+                path = shard_dir(itemdir, len(shards) + 1)
+                if len(shards) > 0:
+                    _make_profile_dir(path)
+                shards.append(itsdb.ItsdbProfile(path))
+                writer = tables.TableWriter(shards[-1], 'item')
+            writer.write(row)
+            shard_of[str(row['i-id'])] = shards[-1]
+    finally:
+        if writer is not None:
+            writer.close()
+    if full:
+        _split_rows(shard_of, 'p-info', _parse_info_rows(item))
+        _split_rows(shard_of, 'p-result', _parse_result_rows(item))
+    return [p.root for p in shards] or [shard_dir(itemdir, 1)]
+
+
+def _split_rows(shard_of, table, rows):
+    # rows of items that were not imported are dropped, as with a join;
+    # rows usually come in item order, so only the current shard's
+    # table is open, and a shard whose rows resume later is appended to
+    writer = current = None
+    started = set()
+    try:
+        for row in rows:
+            p = shard_of.get(str(row['i-id']))
+            if p is None:
+                continue
+            if p.root != current:
+                if writer is not None:
+                    writer.close()
+                writer = tables.TableWriter(p, table,
+                                            append=p.root in started)
+                started.add(p.root)
+                current = p.root
+            writer.write(row)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def shard_dir(itemdir, n):
+    """
+    Return the directory of the *n*th (from 1) shard of *itemdir*.
+    """
+    return '{}.shard{:03d}'.format(itemdir, n)
+
+
+def _remove_profiles(itemdir, sharded):
+    # the profile of an item, or its shards
+    if not sharded:
+        shutil.rmtree(itemdir, ignore_errors=True)
+        return
+    n = 1
+    while os.path.isdir(shard_dir(itemdir, n)):
+        shutil.rmtree(shard_dir(itemdir, n), ignore_errors=True)
+        n += 1
+
+
+def _make_profile_dir(path):
+    os.makedirs(path)
+    with open(os.path.join(path, 'relations'), 'w') as fh:
+        print(relations_string, file=fh)
+
+
+def _write_rows(p, table, rows):
+    with tables.TableWriter(p, table) as writer:
+        for row in rows:
+            writer.write(row)
+
+
 def item_rows(item, reverse=False):
-    data = []
+    """
+    Yield the rows of the item table for *item*, a profile or a file
+    of tab-separated source and target sentences.
+    """
     if os.path.isdir(item):
-        p = itsdb.ItsdbProfile(item)
-        output_fn = os.path.join(p.root, 'output')
-        if ((os.path.isfile(output_fn) or os.path.isfile(output_fn + '.gz'))
-                and len(list(p.read_table('output'))) > 0):
-            for row in p.join('item', 'output'):
-                data.append((
-                    row['item:i-id'],
-                    row['item:i-input'],
-                    row['output:o-surface']
-                ))
-        else:
-            data.extend(p.select('item', ['i-id', 'i-input', 'i-translation']))
+        data = _profile_items(itsdb.ItsdbProfile(item))
     elif os.path.isfile(item):
-        for i, line in enumerate(open(item)):
-            src, tgt = line.split('\t', 1)
-            data.append(((i+1)*10, src.rstrip(), tgt.rstrip()))
+        data = _file_items(item)
     else:
         raise ValueError('Invalid item: ' + str(item))
 
-    rows = []
     for i_id, src, tgt in data:
         if reverse:
             src, tgt = tgt, src
-        rows.append({
+        yield {
             'i-id': i_id,
             'i-input': src,
             'i-length': len(src.split()),
             'i-translation': tgt
-        })
-    return rows
-
-
-def _parse_tables(item):
-    info, results = [], []
-    makeinfo = lambda a, b, c: {
-        'i-id': a, 'time': b, 'memory': c
-    }
-    makeresult = lambda a, b, c, d, e: {
-        'i-id': a, 'p-id': b, 'derivation': c, 'mrs': d, 'score': e
-    }
-    if os.path.isdir(item):
-        p = itsdb.ItsdbProfile(item)
-        fn = os.path.join(p.root, 'parse')
-        if os.path.isfile(fn) or os.path.isfile(fn + '.gz'):
-            for row in p.read_table('parse'):
-                info.append(makeinfo(row['i-id'], row['total'], row['others']))
-        fn = os.path.join(p.root, 'result')
-        if os.path.isfile(fn) or os.path.isfile(fn + '.gz'):
-            for row in p.join('parse', 'result'):
-                results.append(makeresult(
-                    row['parse:i-id'], row['result:result-id'],
-                    row['result:derivation'], row['result:mrs'],
-                    '1.0'  # for now
-                    ))
+        }
+
+
+def _profile_items(p):
+    # like p.join('item', 'output'), but only the output strings are
+    # kept in memory instead of the full rows
+    outputs = {}
+    if _has_table(p, 'output'):
+        for i_id, surface in p.select('output', ['i-id', 'o-surface']):
+            outputs.setdefault(i_id, []).append(surface)
+    if outputs:
+        for i_id, src in p.select('item', ['i-id', 'i-input']):
+            for surface in outputs.get(i_id, []):
+                yield (i_id, src, surface)
     else:
-        raise ValueError('Only profiles allowed with --full: ' + str(item))
-    return info, results
+        yield from p.select('item', ['i-id', 'i-input', 'i-translation'])
+
+
+def _file_items(path):
+    with open(path) as fh:
+        for i, line in enumerate(fh):
+            src, tgt = line.split('\t', 1)
+            yield ((i+1)*10, src.rstrip(), tgt.rstrip())
+
+
+def _parse_info_rows(item):
+    p = itsdb.ItsdbProfile(item)
+    if _has_table(p, 'parse'):
+        for row in p.read_table('parse'):
+            yield {
+                'i-id': row['i-id'], 'time': row['total'],
+                'memory': row['others']
+            }
+
+
+def _parse_result_rows(item):
+    # p.join('parse', 'result') would read the whole result table, so
+    # only the parse-id to i-id mapping is kept in memory and results
+    # are streamed in the order of the result table
+    p = itsdb.ItsdbProfile(item)
+    if not (_has_table(p, 'parse') and _has_table(p, 'result')):
+        return
+    i_ids = dict(p.select('parse', ['parse-id', 'i-id']))
+    for row in p.read_table('result'):
+        if row['parse-id'] in i_ids:
+            yield {
+                'i-id': i_ids[row['parse-id']],
+                'p-id': row['result-id'],
+                'derivation': row['derivation'],
+                'mrs': row['mrs'],
+                'score': '1.0'  # for now
+            }
+
+
+def _has_table(p, table):
+    fn = os.path.join(p.root, table)
+    return os.path.isfile(fn) or os.path.isfile(fn + '.gz')
 
 
 def _unique_pathname(d, bn):
     fn = os.path.join(d, bn)
     i = 0
-    while os.path.exists(fn):
+    while os.path.exists(fn) or os.path.exists(shard_dir(fn, 1)):
         i += 1
         fn = os.path.join(d, bn + '.' + str(i))
     return fn
@@ -0,0 +1,81 @@
+
+import os
+import shutil
+import logging
+
+from delphin import itsdb
+
+from xmt import tables, columnar
+
+# tables concatenated by a merge; the run statistics are left out as
+# their run numbers are only meaningful within one profile
+MERGED_TABLES = (
+    'item',
+    'p-info', 'p-result',
+    'x-info', 'x-result',
+    'g-info', 'g-result',
+    'r-info', 'r-result',
+)
+
+
+def do(args):
+    dest = os.path.normpath(args['PROFILE'])
+    sources = [itsdb.ItsdbProfile(os.path.normpath(item))
+               for item in args['ITEM']]
+    merge(dest, sources)
+
+
+def merge(dest, sources):
+    """
+    Create the profile *dest* with the rows of the tables of each
+    profile in *sources*, in order.
+
+    The shards created by `xmt init --shard-size` keep the i-ids of
+    the original item, so merging them gives the profile that
+    importing the item whole would have given, with the results of
+    the tasks run on the shards.
+
+    Args:
+        dest: the directory of the new profile; it must not exist
+        sources: the [ItsdbProfile] objects to merge
+    """
+    if os.path.exists(dest):
+        raise ValueError('Profile already exists: ' + str(dest))
+    if not sources:
+        raise ValueError('No profiles to merge')
+    os.makedirs(dest)
+    shutil.copy(os.path.join(sources[0].root, 'relations'), dest)
+    p = itsdb.ItsdbProfile(dest)
+
+    i_ids = set()
+    repeated = 0
+    for table in MERGED_TABLES:
+        if table not in p.relations:
+            continue
+        n = 0
+        with tables.TableWriter(p, table) as writer:
+            for src in sources:
+                for row in _rows(src, table):
+                    if table == 'item':
+                        if row['i-id'] in i_ids:
+                            repeated += 1
+                        i_ids.add(row['i-id'])
+                    writer.write(row)
+                    n += 1
+        logging.info('Merged {} rows of {}'.format(n, table))
+    if repeated:
+        logging.warning(
+            '{} items of the merged profiles have the same i-id as an '
+            'earlier item'.format(repeated)
+        )
+
+    if any(columnar.enabled(src) for src in sources):
+        columnar.pack(p)
+    return p
+
+
+def _rows(p, table):
+    try:
+        yield from columnar.read_table(p, table)
+    except itsdb.ItsdbError:
+        pass  # missing tables have no rows
@@ -1,17 +1,152 @@
 
+import math
+from array import array
+from collections import Counter
 
-from nltk.translate import bleu_score
-from nltk.tokenize.toktok import ToktokTokenizer
+from xmt import tokens
 
-_tokenize = ToktokTokenizer().tokenize
-_smoother = bleu_score.SmoothingFunction().method3
+MAX_N = 4
 
 
 def bleu(pairs):
-    score = bleu_score.corpus_bleu(
-        [[_tokenize(ref.lower())] for _, ref in pairs],
-        [_tokenize(hyp.lower()) for hyp, _ in pairs],
-        smoothing_function=_smoother
-    )
-    return score
+    """
+    Return the corpus BLEU score of (hypothesis, reference) *pairs*.
+    """
+    return bleu_stats(pairs).score()
 
+
+def bleu_stats(pairs, tokenizer='toktok', lowercase=True):
+    """
+    Return the [BleuStats] of (hypothesis, reference) *pairs*.
+
+    Args:
+        pairs: an iterable of (hypothesis, reference) string pairs
+        tokenizer: the name of the tokenizer (see tokens.tokenize())
+        lowercase: if `True`, lowercase strings before tokenizing
+    """
+    stats = BleuStats()
+    for hyp, ref in pairs:
+        stats.add(tokens.tokenize(hyp, tokenizer, lowercase),
+                  tokens.tokenize(ref, tokenizer, lowercase))
+    return stats
+
+
+def ngram_counts(tokens, max_n=MAX_N):
+    """
+    Return a list of Counters of the 1- to *max_n*-grams in *tokens*.
+    """
+    tokens = tuple(tokens)
+    return [
+        Counter(tokens[i:i+n] for i in range(len(tokens) - n + 1))
+        for n in range(1, max_n + 1)
+    ]
+
+
+class BleuStats(object):
+    """
+    Sufficient statistics for computing BLEU scores.
+
+    For each hypothesis/reference pair, the number of clipped n-gram
+    matches and hypothesis n-grams (for n from 1 to *max_n*) and the
+    hypothesis and reference lengths are stored in integer arrays.
+    Statistics of several sets of pairs can be combined with `+`, so
+    the corpus BLEU score of a workspace is computed from those of
+    its profiles without tokenizing or matching anything again.
+
+    Scores are the same as those of `nltk.translate.bleu_score` with
+    uniform weights and smoothing method 3 (NIST geometric sequence
+    smoothing).
+    """
+
+    def __init__(self, max_n=MAX_N):
+        self.max_n = max_n
+        self.matches = [array('l') for _ in range(max_n)]
+        self.totals = [array('l') for _ in range(max_n)]
+        self.hyp_lengths = array('l')
+        self.ref_lengths = array('l')
+        self._score = None
+
+    def __len__(self):
+        return len(self.hyp_lengths)
+
+    def __add__(self, other):
+        if self.max_n != other.max_n:
+            raise ValueError('cannot combine BLEU statistics of different '
+                             'n-gram orders')
+        stats = BleuStats(self.max_n)
+        for i in range(self.max_n):
+            stats.matches[i] = self.matches[i] + other.matches[i]
+            stats.totals[i] = self.totals[i] + other.totals[i]
+        stats.hyp_lengths = self.hyp_lengths + other.hyp_lengths
+        stats.ref_lengths = self.ref_lengths + other.ref_lengths
+        return stats
+
+    def add(self, hyp, ref, ref_counts=None):
+        """
+        Add the statistics of the tokenized hypothesis *hyp* against
+        the tokenized reference *ref*. If the same reference is used
+        for several hypotheses, its *ref_counts* from ngram_counts()
+        may be given to avoid counting them again.
+        """
+        if ref_counts is None:
+            ref_counts = ngram_counts(ref, self.max_n)
+        hyp_counts = ngram_counts(hyp, self.max_n)
+        for i in range(self.max_n):
+            rc = ref_counts[i]
+            self.matches[i].append(
+                sum(min(c, rc[ng]) for ng, c in hyp_counts[i].items()
+                    if ng in rc)
+            )
+            self.totals[i].append(sum(hyp_counts[i].values()))
+        self.hyp_lengths.append(len(hyp))
+        self.ref_lengths.append(len(ref))
+        self._score = None
+
+    def score(self):
+        """
+        Return the corpus BLEU score of all pairs.
+        """
+        if self._score is None:
+            self._score = _score(
+                [sum(m) for m in self.matches],
+                # as in nltk, each pair counts at least one n-gram
+                [sum(max(t, 1) for t in ts) for ts in self.totals],
+                sum(self.hyp_lengths),
+                sum(self.ref_lengths)
+            )
+        return self._score
+
+    def sentence_scores(self):
+        """
+        Return a list of the BLEU scores of each pair on its own.
+        """
+        return [
+            _score([m[j] for m in self.matches],
+                   [max(t[j], 1) for t in self.totals],
+                   self.hyp_lengths[j],
+                   self.ref_lengths[j])
+            for j in range(len(self))
+        ]
+
+
+def _score(matches, totals, hyp_len, ref_len):
+    if not matches or matches[0] == 0:
+        return 0.0
+    if hyp_len > ref_len:
+        bp = 1.0
+    elif hyp_len == 0:
+        bp = 0.0
+    else:
+        bp = math.exp(1 - ref_len / float(hyp_len))
+    # smoothing method 3: the kth zero precision becomes 1/(2**k * total)
+    k = 1
+    precisions = []
+    for m, t in zip(matches, totals):
+        if m == 0:
+            precisions.append(1.0 / (2 ** k * t))
+            k += 1
+        else:
+            precisions.append(m / float(t))
+    # summed as nltk does, so equal scores there are equal here
+    w = 1.0 / len(precisions)
+    return bp * math.exp(math.fsum(w * math.log(p) for p in precisions))
@@ -0,0 +1,117 @@
+
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+# phases in the order they are reported; others follow alphabetically
+PHASES = (
+    'config loading',
+    'table read',
+    'ACE wait',
+    'result conversion',
+    'table write',
+    'tokenization',
+    'scoring',
+)
+
+_lock = threading.Lock()
+_seconds = {}
+_calls = {}
+_local = threading.local()
+_start = time.perf_counter()
+
+
+@contextmanager
+def phase(name):
+    """
+    Charge the time spent in the context to the phase *name*.
+
+    Phases may be nested, in which case the time of the inner phase
+    is not charged to the outer one, so the times of all phases add
+    up to no more than the time spent in them. Each thread has its
+    own nesting.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    now = time.perf_counter()
+    if stack:
+        outer = stack[-1]
+        _charge(outer[0], now - outer[1], 0)
+    entry = [name, now]
+    stack.append(entry)
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        stack.pop()
+        _charge(name, now - entry[1], 1)
+        if stack:
+            stack[-1][1] = now
+
+
+def timed(name, iterable):
+    """
+    Yield the items of *iterable*, charging the time spent getting
+    each of them to the phase *name*.
+    """
+    it = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def add(name, seconds, calls=1):
+    """
+    Charge *seconds* measured elsewhere to the phase *name*.
+    """
+    _charge(name, seconds, calls)
+
+
+def _charge(name, seconds, calls):
+    with _lock:
+        _seconds[name] = _seconds.get(name, 0.0) + seconds
+        _calls[name] = _calls.get(name, 0) + calls
+
+
+def totals():
+    """
+    Return a list of (name, seconds, calls) triples for the phases
+    timed so far, in reporting order.
+    """
+    with _lock:
+        names = [name for name in PHASES if name in _seconds]
+        names += sorted(set(_seconds).difference(PHASES))
+        return [(name, _seconds[name], _calls[name]) for name in names]
+
+
+def reset():
+    """
+    Forget the phase times so far (e.g., in a worker process, before
+    each call whose times are returned to the parent process).
+    """
+    with _lock:
+        _seconds.clear()
+        _calls.clear()
+
+
+def report():
+    """
+    Log the phase times at the debug level (`-vv`). The phases of
+    worker processes are included if their calls were wrapped with
+    util.worker().
+    """
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    wall = time.perf_counter() - _start
+    lines = ['Phase times ({:0.2f}s total):'.format(wall)]
+    for name, seconds, calls in totals():
+        lines.append('  {:<18} {:>9.3f}s {:>6.1%} {:>9} calls'.format(
+            name, seconds, seconds / (wall or 1.0), calls))
+    if len(lines) > 1:
+        logging.debug('\n'.join(lines))
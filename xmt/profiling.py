@@ -0,0 +1,130 @@
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import logging
+from functools import wraps
+from contextlib import contextmanager
+
+# since Python 3.12, a profiler sees all threads of the process
+_SHARED = sys.version_info >= (3, 12)
+
+_lock = threading.Lock()
+_profilers = []  # one for each profiled thread of this process
+_local = threading.local()  # the profiler of the current thread
+_path = None  # where the statistics of this process are written
+_pid = None  # the process that called start()
+
+
+def start(path, name):
+    """
+    Profile the calling thread, and the functions wrapped with
+    thread() that other threads call, until stop(), which writes the
+    statistics of all of them to *path*, or to a new file in *path*
+    if it is a directory, named after the command *name*.
+    """
+    global _path, _pid
+    if os.path.isdir(path):
+        path = os.path.join(path, '{}-{}-{}.pstats'.format(
+            name, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    with _lock:
+        # those of the parent of a forked worker process
+        inherited = list(_profilers)
+        del _profilers[:]
+    for profiler in inherited:
+        profiler.disable()
+    _path = path
+    _pid = os.getpid()
+    _local.profiler = _enable()
+
+
+def stop():
+    """
+    Stop profiling and write the statistics; return the path of the
+    file written, or `None` if nothing was profiled.
+    """
+    global _path
+    path, _path = _path, None
+    if path is None or not _write(path):
+        return None
+    return path
+
+
+def thread(func):
+    """
+    Wrap *func*, the target of a thread or a thread pool, so it is
+    profiled in the thread calling it while profiling. Each thread
+    has one profiler for all its calls.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _path is not None and not _SHARED and _pid == os.getpid():
+            if getattr(_local, 'profiler', None) is None:
+                _local.profiler = _enable()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def worker(path):
+    """
+    Profile the context in a worker process of a command profiled to
+    *path* (see worker_path()), if it is not `None`.
+
+    The statistics of each worker process are written to a file of
+    their own next to *path*, which is updated after each use of the
+    context, so they are complete when the worker process exits.
+    """
+    if path is None:
+        yield
+        return
+    if _pid != os.getpid():
+        root, ext = os.path.splitext(path)
+        start('{}-{}{}'.format(root, os.getpid(), ext), None)
+    elif getattr(_local, 'profiler', None) is not None:
+        # writing the statistics disabled it
+        _local.profiler.enable()
+    try:
+        yield
+    finally:
+        _write(_path)
+
+
+def worker_path():
+    """
+    Return the path of the statistics of this process for worker(),
+    or `None` if it is not profiled.
+    """
+    return _path
+
+
+def _enable():
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        logging.warning('Not profiling; another profiler is active')
+        return None
+    with _lock:
+        _profilers.append(profiler)
+    return profiler
+
+
+def _write(path):
+    # creating the statistics disables the profilers
+    with _lock:
+        profilers = list(_profilers)
+    if not profilers:
+        return False
+    stats = pstats.Stats()
+    for profiler in profilers:
+        try:
+            stats.add(profiler)
+        except TypeError:
+            pass  # nothing was called in the thread
+    stats.dump_stats(path)
+    logging.debug('Profiled {} threads'.format(len(profilers)))
+    return True
@@ -0,0 +1,203 @@
+
+import os
+import json
+import threading
+from contextlib import ExitStack
+import concurrent.futures
+import logging
+
+from delphin import itsdb
+
+from xmt import task, stats, util, profiling
+
+# the fingerprints of the last successful run of each stage
+_RECORD_FILE = 'stages.json'
+
+_records_lock = threading.Lock()
+
+
+def do(args):
+    tasknames = [name.strip() for name in args['--tasks'].split(',')]
+    for name in tasknames:
+        if name not in task.tasks:
+            raise ValueError('Invalid task: ' + name)
+    run(args['ITEM'], tasknames, args,
+        workers=int(args.get('--workers') or 1),
+        force=args.get('--force'),
+        dry_run=args.get('--dry-run'))
+
+
+def dependencies(tasknames):
+    """
+    Return a mapping of each of *tasknames*, and of the tasks they
+    depend on, to the task whose results are its input, or to `None`
+    if its input is the item table.
+    """
+    producers = {t.prefix + '-result': name
+                 for name, t in task.tasks.items()}
+    deps = {}
+    todo = list(tasknames)
+    while todo:
+        name = todo.pop()
+        if name not in deps:
+            deps[name] = producers.get(task.tasks[name].in_table)
+            if deps[name] is not None:
+                todo.append(deps[name])
+    return deps
+
+
+def plan(items, tasknames, args, force=False):
+    """
+    Return the (itemdir, taskname) stages of *items* that are stale,
+    in an order where each comes after the stage it depends on.
+
+    A stage is stale if its input table, its configuration, or its
+    grammar changed since it last ran, if its output tables changed
+    since then, or if the stage it depends on is stale.
+    """
+    deps = dependencies(tasknames)
+    order = sorted(deps, key=lambda name: _depth(deps, name))
+    stages = []
+    for itemdir in items:
+        records = _read_records(itemdir)
+        stale = {}
+        for name in order:
+            upstream = deps[name]
+            stale[name] = (
+                force
+                or (upstream is not None and stale[upstream])
+                or records.get(name) != _record(itemdir, name, args)
+            )
+            if stale[name]:
+                stages.append((itemdir, name))
+    return stages
+
+
+def run(items, tasknames, args, workers=1, force=False, dry_run=False):
+    """
+    Run the stale stages of *tasknames* (see plan()) on *items*.
+
+    Up to *workers* stages run at once. A stage starts when the stage
+    it depends on has finished, so independent stages, such as the
+    transfer and rephrasing of the same parses, run concurrently.
+    Stages depending on a failed stage are skipped, and the first
+    error is raised when the others have finished.
+    """
+    stages = plan(items, tasknames, args, force=force)
+    if dry_run:
+        for itemdir, name in stages:
+            print('{}\t{}'.format(itemdir, name))
+        return
+    if not stages:
+        logging.info('All stages are up to date')
+        return
+    deps = dependencies(tasknames)
+    # task memory limits account for the stages running at once
+    args = dict(args, **{'--profiles-parallel': str(workers)})
+    index = {itemdir: i for i, itemdir in enumerate(items)}
+
+    waiting = list(stages)
+    queued = set(stages)
+    running = {}
+    failed = set()
+    errors = []
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with ExitStack() as stack, pool:
+        recorders = {}
+        while waiting or running:
+            for stage in list(waiting):
+                itemdir, name = stage
+                upstream = (itemdir, deps[name])
+                if upstream in failed:
+                    logging.warning('Skipping {} of {}'.format(name, itemdir))
+                    waiting.remove(stage)
+                    queued.discard(stage)
+                    failed.add(stage)
+                elif upstream not in queued:
+                    if itemdir not in recorders:
+                        p = itsdb.ItsdbProfile(itemdir)
+                        recorders[itemdir] = stack.enter_context(
+                            stats.RunRecorder(p)
+                        )
+                    future = pool.submit(
+                        profiling.thread(_run_stage), itemdir, name, args, index[itemdir],
+                        recorders[itemdir]
+                    )
+                    running[future] = stage
+                    waiting.remove(stage)
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                stage = running.pop(future)
+                queued.discard(stage)
+                if future.exception() is not None:
+                    logging.error('{1} of {0} failed: {2}'
+                                  .format(*stage, future.exception()))
+                    failed.add(stage)
+                    errors.append(future.exception())
+    if errors:
+        raise errors[0]
+
+
+def _run_stage(itemdir, taskname, args, i, recorder):
+    # the inputs are fingerprinted before they are read, so changes
+    # made while the stage runs make it stale again
+    record = _record(itemdir, taskname, args, outputs=False)
+    task._do_item(taskname, args, i, itemdir, recorder=recorder)
+    t = task.tasks[taskname]
+    record['outputs'] = util.table_fingerprint(
+        itemdir, (t.prefix + '-info', t.prefix + '-result')
+    )
+    with _records_lock:
+        records = _read_records(itemdir)
+        records[taskname] = record
+        path = os.path.join(itemdir, _RECORD_FILE)
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(records, fh, indent=1)
+        os.replace(path + '.tmp', path)
+    return itemdir
+
+
+def _record(itemdir, taskname, args, outputs=True):
+    t = task.tasks[taskname]
+    config = dict(task._item_config(taskname, itemdir, args)[taskname])
+    grammar = config.get('grammar')
+    record = {
+        'inputs': util.table_fingerprint(itemdir, (t.in_table,)),
+        'config': config,
+        'grammar': (_file_stat(os.path.expanduser(grammar))
+                    if grammar else None),
+    }
+    if outputs:
+        record['outputs'] = util.table_fingerprint(
+            itemdir, (t.prefix + '-info', t.prefix + '-result')
+        )
+    return record
+
+
+def _file_stat(path):
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _read_records(itemdir):
+    path = os.path.join(itemdir, _RECORD_FILE)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        logging.warning('Ignoring unreadable stage records {}'.format(path))
+        return {}
+
+
+def _depth(deps, name):
+    depth = 0
+    while deps[name] is not None:
+        name = deps[name]
+        depth += 1
+    return depth
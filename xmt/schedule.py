@@ -0,0 +1,134 @@
+
+import os
+import math
+import logging
+
+
+def available_memory():
+    """
+    Return the memory in bytes available for new processes, or `None`
+    if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def process_memory(task_conf):
+    """
+    Return the maximum memory in bytes an ACE process may use given the
+    chart and unpacking limits in *task_conf*.
+    """
+    megabytes = (task_conf.getint('max-chart-megabytes', fallback=1200) +
+                 task_conf.getint('max-unpack-megabytes', fallback=1500))
+    return megabytes * 1024 * 1024
+
+
+def max_jobs(task_conf, jobs, concurrent=1):
+    """
+    Return the number of ACE processes, up to *jobs*, that fit in the
+    available memory when *concurrent* groups of them (e.g., profiles
+    processed in parallel) run at the same time.
+    """
+    available = available_memory()
+    if available is None:
+        return jobs
+    fitting = max(available // (process_memory(task_conf) * concurrent), 1)
+    if fitting < jobs:
+        logging.warning(
+            'Reducing ACE processes from {} to {} to fit in {} MB of '
+            'available memory'
+            .format(jobs, fitting, available // (1024 * 1024))
+        )
+        return fitting
+    return jobs
+
+
+class CostModel(object):
+    """
+    Predict the processing time and memory of task inputs.
+
+    Inputs that were processed before are predicted to cost what
+    they cost then. For other inputs, costs are predicted from the
+    size of the input (its number of whitespace-separated tokens,
+    which works for sentences as well as MRSs) by fitting a power
+    law `cost = a * size**b` to the previous observations.
+
+    Args:
+        history: a mapping of source keys to (size, time, memory)
+            triples of previous observations; a negative time or
+            memory means it was not recorded
+    """
+
+    def __init__(self, history):
+        self.history = history
+        times = [(size, t) for size, t, _ in history.values() if t >= 0]
+        self.has_times = len(times) > 0
+        self._time_fit = _fit(times)
+        self._memory_fit = _fit(
+            [(size, m) for size, _, m in history.values() if m >= 0]
+        )
+
+    def estimate(self, key, size):
+        """
+        Return the predicted (time, memory) of the input with the
+        source key *key* and *size* tokens.
+        """
+        time = memory = -1
+        if key in self.history:
+            _, time, memory = self.history[key]
+        if time < 0:
+            time = _predict(self._time_fit, size)
+        if memory < 0:
+            memory = _predict(self._memory_fit, size)
+        return time, memory
+
+    def order(self, rows, key, size):
+        """
+        Return *rows* sorted by decreasing predicted time, where
+        `key(row)` and `size(row)` give the source key and size of
+        a row. Ties keep their original order.
+        """
+        estimates = [self.estimate(key(row), size(row)) for row in rows]
+        order = sorted(range(len(rows)), key=lambda i: -estimates[i][0])
+        if not self.has_times:
+            logging.debug('No previous processing times; ordering by size')
+        elif estimates:
+            logging.debug(
+                'Expected total time {:.1f}s, max memory {} MB, '
+                'longest item {:.1f}s'
+                .format(sum(t for t, _ in estimates) / 1000.0,
+                        int(max(m for _, m in estimates) / (1024 * 1024)),
+                        estimates[order[0]][0] / 1000.0)
+            )
+        return [rows[i] for i in order]
+
+
+def _fit(points):
+    # least-squares fit of log(cost) = log(a) + b * log(size); with
+    # too few distinct sizes, cost is proportional to size
+    points = [(max(size, 1), max(cost, 1)) for size, cost in points]
+    if not points:
+        return (1.0, 1.0)
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(cost) for _, cost in points]
+    n = float(len(points))
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return (math.exp(my - mx), 1.0)
+    b = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    return (math.exp(my - b * mx), b)
+
+
+def _predict(fit, size):
+    a, b = fit
+    return a * (max(size, 1) ** b)
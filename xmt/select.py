@@ -1,15 +1,17 @@
 
 import os
-from itertools import groupby
-
-from nltk.translate import bleu_score
-from nltk.tokenize.moses import MosesTokenizer
+from collections import deque, defaultdict
+from functools import partial
+from contextlib import ExitStack
+import concurrent.futures
 
 from delphin import itsdb
 
-_tokenize = MosesTokenizer().tokenize
-_smoother = bleu_score.SmoothingFunction().method3
-bleu = bleu_score.sentence_bleu
+from xmt import util, metrics, tokens, columnar, phases
+
+# items per task when scoring oracle candidates in parallel
+_CHUNK_SIZE = 100
+
 
 def do(args):
     join_table = 'g-result'
@@ -23,66 +25,182 @@ def do(args):
     if args['--tokenize']:
         make_hyp = make_ref = lambda s: ' '.join(_tokenize(s))
 
-    select = select_oracle if args['--oracle-bleu'] else select_first
+    select = select_first
+    if args['--oracle-bleu']:
+        select = partial(select_oracle,
+                         processes=int(args.get('--jobs') or 1))
 
     for i, itemdir in enumerate(args['ITEM']):
         itemdir = os.path.normpath(itemdir)
         p = itsdb.ItsdbProfile(itemdir)
-        if args['--item-id']:
-            for i_id, hyp, ref in select(
-                    p, join_table, hyp_spec, ref_spec, with_id=True):
-                print(
-                    '{}\t{}\t{}'.format(i_id, make_hyp(hyp), make_ref(ref))
-                )
-        else:
-            for hyp, ref in select(p, join_table, hyp_spec, ref_spec):
-                print('{}\t{}'.format(make_hyp(hyp), make_ref(ref)))
+        with ExitStack() as stack:
+            if args.get('--token-cache'):
+                stack.enter_context(tokens.profile_cache(p))
+            if args['--item-id']:
+                for i_id, hyp, ref in select(
+                        p, join_table, hyp_spec, ref_spec, with_id=True):
+                    print(
+                        '{}\t{}\t{}'
+                        .format(i_id, make_hyp(hyp), make_ref(ref))
+                    )
+            else:
+                for hyp, ref in select(p, join_table, hyp_spec, ref_spec):
+                    print('{}\t{}'.format(make_hyp(hyp), make_ref(ref)))
 
 
 def select_first(p, join_table, hyp_spec, ref_spec, with_id=False):
     """
-    Return (hypothesis, reference) translation pairs using the first
+    Yield (hypothesis, reference) translation pairs using the first
     realization result per item.
     """
-    pairs = []
-    try:
-        rows = list(p.join('item', join_table))
-    except itsdb.ItsdbError:
-        rows = []
-    for i_id, group in groupby(rows, key=lambda row: row['item:i-id']):
-        row = next(group)
-        pair = [row[hyp_spec], row[ref_spec]]
-        if with_id:
-            pair = [i_id] + pair
-        pairs.append(tuple(pair))
-    return pairs
+    return iter_first(
+        _stream_candidates(p, join_table, hyp_spec, ref_spec), with_id
+    )
 
 
-def select_oracle(p, join_table, hyp_spec, ref_spec, with_id=False):
+def select_oracle(p, join_table, hyp_spec, ref_spec, with_id=False,
+                  processes=1):
     """
-    Return (hypothesis, reference) translation pairs using the
+    Yield (hypothesis, reference) translation pairs using the
     realization result per item with the highest BLEU score.
     """
-    pairs = []
+    return iter_oracle(
+        _stream_candidates(p, join_table, hyp_spec, ref_spec), with_id,
+        processes=processes
+    )
+
+
+def first_pairs(candidates, with_id=False):
+    """
+    Return (hypothesis, reference) pairs using the first hypothesis of
+    each (i_id, hypotheses, reference) triple in *candidates*.
+    """
+    return list(iter_first(candidates, with_id))
+
+
+def oracle_pairs(candidates, with_id=False, processes=1):
+    """
+    Return (hypothesis, reference) pairs using the hypothesis with the
+    highest BLEU score of each (i_id, hypotheses, reference) triple in
+    *candidates*. If *processes* is greater than 1, items are scored
+    in that many worker processes.
+    """
+    return list(iter_oracle(candidates, with_id, processes))
+
+
+def iter_first(candidates, with_id=False):
+    """
+    Like first_pairs(), but yield each pair as soon as its candidates
+    have been read.
+    """
+    for i_id, hyps, ref in candidates:
+        yield _pair(i_id, hyps[0], ref, with_id)
+
+
+def iter_oracle(candidates, with_id=False, processes=1):
+    """
+    Like oracle_pairs(), but yield each pair as soon as its candidates
+    have been read and scored. With several *processes*, at most two
+    chunks of items per process are pending at a time.
+    """
+    if processes > 1:
+        best = _parallel_oracle(candidates, processes)
+    else:
+        best = map(_oracle, candidates)
+    for i_id, hyp, ref in best:
+        yield _pair(i_id, hyp, ref, with_id)
+
+
+def _pair(i_id, hyp, ref, with_id):
+    if with_id:
+        return (i_id, hyp, ref)
+    return (hyp, ref)
+
+
+def _parallel_oracle(candidates, processes):
+    pending = deque()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    with pool:
+        for chunk in _chunks(candidates):
+            pending.append(pool.submit(util.worker(_oracle_chunk), chunk))
+            if len(pending) >= processes * 2:
+                yield from util.collect(pending.popleft().result())
+        while pending:
+            yield from util.collect(pending.popleft().result())
+
+
+def _oracle(candidate):
+    # the reference is tokenized and its n-grams counted once for all
+    # hypotheses; on ties the last hypothesis wins
+    i_id, hyps, ref = candidate
+    if len(hyps) == 1:
+        return i_id, hyps[0], ref
+    with phases.phase('scoring'):
+        ref_tokens = _tokenize(ref)
+        ref_counts = metrics.ngram_counts(ref_tokens)
+        stats = metrics.BleuStats()
+        for hyp in hyps:
+            stats.add(_tokenize(hyp), ref_tokens, ref_counts=ref_counts)
+        scores = stats.sentence_scores()
+    best = max(range(len(hyps)), key=lambda j: (scores[j], j))
+    return i_id, hyps[best], ref
+
+
+def _oracle_chunk(candidates):
+    return [_oracle(candidate) for candidate in candidates]
+
+
+def _chunks(candidates, size=_CHUNK_SIZE):
+    chunk = []
+    for candidate in candidates:
+        chunk.append(candidate)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _tokenize(s):
+    return tokens.tokenize(s, 'moses')
+
+
+def _stream_candidates(p, join_table, hyp_spec, ref_spec):
+    # Yield the candidates of each item with results, in item order
+    # and with all of its results, like ProfileSnapshot.candidates().
+    # A first pass counts the results of each item (reading only the
+    # i-id column of columnar tables), so the second can yield an
+    # item's candidates as soon as its last result was read. Only
+    # items whose results are not contiguous (e.g., after --resume)
+    # or not in item order are kept in memory while later ones are
+    # read.
+    hyp_col = hyp_spec.split(':', 1)[1]
+    ref_col = ref_spec.split(':', 1)[1]
     try:
-        rows = list(p.join('item', join_table))
+        with phases.phase('table read'):
+            items = list(p.select('item', ('i-id', ref_col)))
+            refs = dict(items)
+            remaining = {}
+            for i_id in columnar.read_column(p, join_table, 'i-id'):
+                if i_id in refs:  # other results are not joined
+                    remaining[i_id] = remaining.get(i_id, 0) + 1
+        hyps = defaultdict(list)
+        items = iter(items)
+        item = next(items, None)
+        rows = phases.timed('table read', columnar.read_table(p, join_table))
+        for row in rows:
+            i_id = row['i-id']
+            if i_id in refs:
+                hyps[i_id].append(row[hyp_col])
+                remaining[i_id] -= 1
+            while item is not None and remaining.get(item[0], 0) <= 0:
+                if item[0] in hyps:
+                    yield item[0], hyps.pop(item[0]), item[1]
+                item = next(items, None)
+        # in case the table changed between the passes
+        while item is not None:
+            if item[0] in hyps:
+                yield item[0], hyps.pop(item[0]), item[1]
+            item = next(items, None)
     except itsdb.ItsdbError:
-        rows = []
-    for i_id, group in groupby(rows, key=lambda row: row['item:i-id']):
-        scored = []
-        for res in group:
-            pair = [res[hyp_spec], res[ref_spec]]
-            scored.append(
-                tuple(
-                    [bleu([_tokenize(pair[1])], _tokenize(pair[0]),
-                          smoothing_function=_smoother)] +
-                    pair
-                )
-            )
-        best = sorted(scored, key=lambda r: r[0])[-1]
-        pair = list(best[1:])
-        if with_id:
-            pair = [i_id] + pair
-        pairs.append(tuple(pair))
-
-    return pairs
+        pass
@@ -0,0 +1,159 @@
+
+from array import array
+from itertools import groupby
+import logging
+
+from delphin.exceptions import ItsdbError
+
+from xmt import columnar, phases
+
+# integer columns and string columns kept for each table
+_columns = {
+    'item': (('i-id', 'i-length'), ('i-input', 'i-translation')),
+    'p-info': (('i-id', 'time', 'memory'), ('error',)),
+    'p-result': (('i-id', 'p-id'), ()),
+    'x-info': (('i-id', 'p-id', 'time', 'memory'), ('error',)),
+    'x-result': (('i-id', 'p-id', 'x-id'), ()),
+    'g-info': (('i-id', 'p-id', 'x-id', 'time', 'memory'), ('error',)),
+    'g-result': (('i-id', 'p-id', 'x-id', 'g-id'), ('surface',)),
+    'r-info': (('i-id', 'p-id', 'time', 'memory'), ('error',)),
+    'r-result': (('i-id', 'p-id', 'r-id'), ('surface',)),
+}
+
+
+class Table(object):
+    """
+    The columns of one table of a [ProfileSnapshot].
+
+    Integer columns are packed arrays and string columns are lists,
+    all of the same length and in the order of the table's rows.
+    """
+
+    def __init__(self, name, ints, strings):
+        self.name = name
+        self.columns = {col: array('q') for col in ints}
+        self.columns.update((col, []) for col in strings)
+
+    def __len__(self):
+        return len(self.columns['i-id'])
+
+    def __getitem__(self, col):
+        return self.columns[col]
+
+    def distinct(self, *cols):
+        """
+        Return the number of distinct combinations of values in *cols*.
+        """
+        if len(cols) == 1:
+            return len(set(self.columns[cols[0]]))
+        return len(set(zip(*[self.columns[col] for col in cols])))
+
+
+class ProfileSnapshot(object):
+    """
+    Read the tables of profile *p* needed for evaluation.
+
+    Each table is read and decoded at most once, on first use, and
+    only the columns used by the metrics are kept. Missing tables
+    are empty.
+
+    Args:
+        p: the [ItsdbProfile] to read
+        ignore: if given, x-result rows whose MRS contains this
+            string are left out
+    """
+
+    def __init__(self, p, ignore=None):
+        self.p = p
+        self.root = p.root
+        self.ignore = ignore
+        self._tables = {}
+
+    def table(self, name):
+        """
+        Return the [Table] *name*, reading it if necessary.
+        """
+        if name not in self._tables:
+            with phases.phase('table read'):
+                self._tables[name] = self._read(name)
+        return self._tables[name]
+
+    def _read(self, name):
+        ints, strings = _columns[name]
+        table = Table(name, ints, strings)
+        int_columns = [(col, table[col]) for col in ints]
+        str_columns = [(col, table[col]) for col in strings]
+        ignore = self.ignore if name == 'x-result' else None
+        logging.debug('Reading {} from {}'.format(name, self.root))
+        if columnar.exists(self.root, name):
+            return self._read_columnar(name, ints, strings)
+        try:
+            for row in self.p.read_table(name):
+                if ignore is not None and ignore in row['mrs']:
+                    continue
+                for col, values in int_columns:
+                    # unrecorded values (e.g., of time) are -1
+                    values.append(int(row[col] or -1))
+                for col, values in str_columns:
+                    # older profiles lack some columns (e.g., error)
+                    values.append(row.get(col, ''))
+        except (KeyError, ItsdbError):
+            table = Table(name, ints, strings)
+        return table
+
+    def _read_columnar(self, name, ints, strings):
+        # integer columns are used as they are stored and only the
+        # needed string columns are decoded
+        ct = columnar.ColumnarTable(self.root, name)
+        table = Table(name, ints, strings)
+        try:
+            for col in ints:
+                if ct.is_int(col):
+                    table.columns[col] = ct.ints(col)
+                else:
+                    table.columns[col] = array(
+                        'q', (int(v or -1) for v in ct.strings(col))
+                    )
+            for col in strings:
+                if col in ct.encodings:
+                    table.columns[col] = ct.strings(col)
+                else:
+                    table.columns[col] = [''] * len(ct)
+        except KeyError:
+            return Table(name, ints, strings)
+        # like p.read_table(), leave out rows of items not in the item
+        # table, and also those with ignored MRSs
+        keep = None
+        i_ids = set(self.table('item')['i-id'])
+        if not i_ids.issuperset(table['i-id']):
+            keep = [i_id in i_ids for i_id in table['i-id']]
+        ignore = self.ignore if name == 'x-result' else None
+        if ignore is not None and 'mrs' in ct.encodings:
+            ignored = [ignore in mrs for mrs in ct.strings('mrs')]
+            keep = [k and not ig for k, ig in
+                    zip(keep or [True] * len(ct), ignored)]
+        if keep is not None:
+            for col, values in table.columns.items():
+                kept = [v for v, k in zip(values, keep) if k]
+                table.columns[col] = (array('q', kept) if col in ints
+                                      else kept)
+        return table
+
+    def candidates(self, join_table, hyp_col, ref_col):
+        """
+        Yield (i_id, hypotheses, reference) triples for each item with
+        results in *join_table*, in the order of `p.join('item',
+        join_table)`. The hypotheses are the values of *hyp_col* in
+        *join_table* and the reference is the value of *ref_col* in
+        the item table.
+        """
+        items = self.table('item')
+        results = self.table(join_table)
+        hyps = results[hyp_col]
+        groups = {}
+        for i_id, idxs in groupby(range(len(results)),
+                                  key=results['i-id'].__getitem__):
+            groups.setdefault(i_id, []).extend(idxs)
+        for i_id, ref in zip(items['i-id'], items[ref_col]):
+            if i_id in groups:
+                yield i_id, [hyps[idx] for idx in groups[i_id]], ref
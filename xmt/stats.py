@@ -0,0 +1,249 @@
+
+import os
+import threading
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+from delphin import itsdb
+
+from xmt import tables
+
+_run_table = 'run-stats'
+_item_table = 'item-stats'
+
+
+class RunRecorder(object):
+    """
+    Record throughput statistics of task runs on profile *p*.
+
+    Each recorder allocates a new run number. Statistics for each
+    processed input go to the `item-stats` table and a summary of
+    each task to the `run-stats` table. Profiles created before
+    these relations existed are not recorded.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.enabled = (_run_table in p.relations and
+                        _item_table in p.relations)
+        if not self.enabled:
+            logging.warning(
+                'Not recording run statistics; {} does not define the '
+                '{} and {} relations'.format(p.root, _run_table, _item_table)
+            )
+            return
+        runs = [int(row['run']) for row in _rows(p, _run_table)]
+        self.run = max(runs, default=0) + 1
+        self._lock = threading.Lock()
+        self._items = tables.TableWriter(p, _item_table, append=True)
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def item(self, taskname, source, queue, wall, cpu, results, size):
+        """
+        Record the processing of one input. Times are in seconds, except
+        *cpu*, which is the time reported by ACE in milliseconds.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items.write({
+                'run': self.run,
+                'task': taskname,
+                'source': '|'.join(map(str, source)),
+                'queue': _msec(queue),
+                'wall': _msec(wall),
+                'cpu': cpu,
+                'results': results,
+                'bytes': size
+            })
+
+    def task(self, taskname, start, jobs, wall, inputs, results, size,
+             ace, convert, write):
+        """
+        Record the summary of running *taskname*. Times are in seconds.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items.flush()
+            self._runs.append({
+                'run': self.run,
+                'task': taskname,
+                'start': datetime.fromtimestamp(start).isoformat(),
+                'jobs': jobs,
+                'wall': _msec(wall),
+                'inputs': inputs,
+                'results': results,
+                'bytes': size,
+                'ace': _msec(ace),
+                'convert': _msec(convert),
+                'write': _msec(write)
+            })
+
+    def close(self):
+        if not self.enabled:
+            return
+        self._items.close()
+        with tables.TableWriter(self.p, _run_table, append=True) as runs:
+            for row in self._runs:
+                runs.write(row)
+
+
+def do(args):
+    numitems = len(args['ITEM'])
+    totals = defaultdict(_new_summary)
+    for itemdir in args['ITEM']:
+        itemdir = os.path.normpath(itemdir)
+        p = itsdb.ItsdbProfile(itemdir)
+        summaries = profile_summaries(p, run=args.get('--run'))
+        if not summaries:
+            logging.warning('No run statistics for {}'.format(itemdir))
+            continue
+        for taskname, summary in summaries:
+            _merge_summary(totals[taskname], summary)
+        if not args['--summary-only']:
+            print(format_stats(
+                '{} (run {})'.format(itemdir, summaries[0][1]['run']),
+                summaries
+            ))
+    if totals and (numitems > 1 or args['--summary-only']):
+        print(format_stats('Summary', sorted(totals.items(), key=_task_order)))
+
+
+def profile_summaries(p, run=None):
+    """
+    Return a list of (taskname, summary) pairs for the tasks in *run*
+    (or the latest run if *run* is `None`) of profile *p*.
+    """
+    runrows = _rows(p, _run_table)
+    if not runrows:
+        return []
+    if run is None:
+        run = max(int(row['run']) for row in runrows)
+    run = int(run)
+    summaries = {}
+    for row in runrows:
+        if int(row['run']) != run:
+            continue
+        summary = _new_summary()
+        summary['run'] = run
+        for field in ('jobs', 'wall', 'inputs', 'results', 'bytes',
+                      'ace', 'convert', 'write'):
+            summary[field] = int(row[field])
+        summaries[row['task']] = summary
+    for row in _rows(p, _item_table):
+        if int(row['run']) != run or row['task'] not in summaries:
+            continue
+        summary = summaries[row['task']]
+        summary['latency'].append(int(row['wall']))
+        summary['queue'].append(int(row['queue']))
+        cpu = int(row['cpu'])
+        if cpu >= 0:
+            summary['cpu'] += cpu
+            summary['cpu-wall'] += int(row['wall'])
+    return sorted(summaries.items(), key=_task_order)
+
+
+def input_times(p, taskname):
+    """
+    Return a mapping of the source keys of the inputs of *taskname*
+    recorded in profile *p*, as tuples of strings, to their wall time
+    in seconds in the latest run that processed them.
+    """
+    times = {}
+    for row in _rows(p, _item_table):
+        if row['task'] == taskname:
+            times[tuple(row['source'].split('|'))] = int(row['wall']) / 1000.0
+    return times
+
+
+def format_stats(name, summaries):
+    s = '{}:\n'.format(name)
+    for taskname, st in summaries:
+        wall = st['wall'] / 1000.0
+        s += (
+            '  {task:<10} {inputs} inputs, {results} results, {size} bytes '
+            'in {wall:0.2f}s ({rate:0.2f} inputs/s)\n'
+            '    Latency (ms):          p50 {l50:>7} p95 {l95:>7} '
+            'p99 {l99:>7}\n'
+            '    Queue wait (ms):       p50 {q50:>7} p95 {q95:>7} '
+            'p99 {q99:>7}\n'
+            '    ACE interaction:       {ace:6.2%} of wall time x jobs\n'
+            '      ACE-reported CPU:    {cpu:6.2%} of interaction time\n'
+            '    Result conversion:     {convert:6.2%} of wall time\n'
+            '    Table writing:         {write:6.2%} of wall time\n'
+        ).format(
+            task=taskname + ':',
+            inputs=st['inputs'],
+            results=st['results'],
+            size=st['bytes'],
+            wall=wall,
+            rate=st['inputs'] / (wall or 1.0),
+            l50=percentile(st['latency'], 50),
+            l95=percentile(st['latency'], 95),
+            l99=percentile(st['latency'], 99),
+            q50=percentile(st['queue'], 50),
+            q95=percentile(st['queue'], 95),
+            q99=percentile(st['queue'], 99),
+            ace=st['ace'] / float((st['wall'] * st['jobs']) or 1),
+            cpu=st['cpu'] / float(st['cpu-wall'] or 1),
+            convert=st['convert'] / float(st['wall'] or 1),
+            write=st['write'] / float(st['wall'] or 1),
+        )
+    return s
+
+
+def percentile(values, q):
+    """
+    Return the *q*th percentile of *values* by the nearest-rank
+    method, or 0 if there are no values.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(int(-(-q * len(values) // 100)), 1)  # ceiling
+    return values[rank - 1]
+
+
+def _new_summary():
+    return {
+        'run': None, 'jobs': 0, 'wall': 0, 'inputs': 0, 'results': 0,
+        'bytes': 0, 'ace': 0, 'convert': 0, 'write': 0, 'cpu': 0,
+        'cpu-wall': 0, 'latency': [], 'queue': []
+    }
+
+
+def _merge_summary(total, summary):
+    # jobs are averaged by weighting with wall time
+    total['jobs'] = (
+        (total['jobs'] * total['wall'] + summary['jobs'] * summary['wall'])
+        / float((total['wall'] + summary['wall']) or 1)
+    )
+    for key, val in summary.items():
+        if key in ('run', 'jobs'):
+            continue
+        total[key] += val
+
+
+def _task_order(pair):
+    order = ('parse', 'transfer', 'generate', 'rephrase')
+    return order.index(pair[0]) if pair[0] in order else len(order)
+
+
+def _rows(p, table):
+    try:
+        return list(p.read_table(table))
+    except (KeyError, itsdb.ItsdbError):
+        return []
+
+
+def _msec(seconds):
+    return int(seconds * 1000)
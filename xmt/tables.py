@@ -0,0 +1,223 @@
+
+import os
+import gzip
+import shutil
+import logging
+from io import TextIOWrapper
+
+from delphin import itsdb
+
+_TMP_SUFFIX = '.tmp'
+# the size of a table that the temporary file is to be appended to
+_BASE_SUFFIX = '.base'
+
+
+class TableWriter(object):
+    """
+    Write rows to a gzipped [incr tsdb()] table through a single
+    compressed stream.
+
+    Rows are written to a temporary file next to the table, which
+    replaces the table when the writer is closed or, when appending
+    to a gzipped table, is added to it as a new gzip member, so the
+    existing rows are neither copied nor recompressed. Calling
+    flush() makes all rows written so far readable from the
+    temporary file even if the process is later killed (see
+    recover()).
+
+    If *after* is given, the rows of this writer are held in memory
+    until flush() or close(), which first flush *after*, so none of
+    them reaches the disk before the rows written to *after* before
+    them. For instance, with the result table's writer as *after* of
+    the info table's writer, an input with an info row on disk also
+    has its results on disk.
+
+    Args:
+        p: the [ItsdbProfile] containing the table
+        table: the name of the table
+        append: if `True`, keep the existing rows of the table
+        after: a [TableWriter] to flush before writing rows
+    """
+
+    def __init__(self, p, table, append=False, after=None):
+        self.table = table
+        self.fields = p.table_relations(table)
+        self.txtpath = os.path.join(p.root, table)
+        self.path = self.txtpath + '.gz'
+        self.tmppath = self.path + _TMP_SUFFIX
+        self.basepath = self.tmppath + _BASE_SUFFIX
+        self.after = after
+        self.rows = 0
+        self.pending = 0
+        self._held = []
+        self._base = None  # the size of the table appended to
+        if append:
+            # keep the rows of an interrupted writer (e.g., of run
+            # statistics, which are not otherwise recovered)
+            recover(p.root, table)
+        else:
+            discard(p.root, table)
+        self._raw = open(self.tmppath, 'wb')
+        self._copied = append and self._copy_existing()
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        self._fh = TextIOWrapper(self._gz, encoding='utf-8')
+
+    @property
+    def closed(self):
+        return self._raw.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _copy_existing(self):
+        txt = os.path.isfile(self.txtpath)
+        gz = os.path.isfile(self.path)
+        if txt and not (gz and os.stat(self.path).st_mtime >
+                        os.stat(self.txtpath).st_mtime):
+            # compress the uncompressed table as the first member
+            with open(self.txtpath, 'rb') as src, \
+                    gzip.GzipFile(fileobj=self._raw, mode='wb') as dst:
+                shutil.copyfileobj(src, dst)
+            return True
+        elif gz:
+            # gzip files may consist of several members, so the new
+            # rows are appended to the table as one on close; the
+            # table's size is recorded for recover()
+            self._base = os.path.getsize(self.path)
+            with open(self.basepath, 'w') as fh:
+                fh.write(str(self._base))
+        return False
+
+    def write(self, row):
+        """
+        Encode and write *row*, a mapping of column names to values,
+        and return the number of (uncompressed) characters written.
+        """
+        line = itsdb.make_row(row, self.fields) + '\n'
+        if self.after is not None:
+            self._held.append(line)
+        else:
+            self._fh.write(line)
+        self.rows += 1
+        self.pending += len(line)
+        return len(line)
+
+    def flush(self):
+        """
+        Make the rows written so far durable in the temporary file.
+        """
+        if self.after is not None:
+            if not self.after.closed:
+                self.after.flush()
+            self._fh.writelines(self._held)
+            self._held = []
+        self._fh.flush()
+        self._gz.flush()  # zlib sync flush, so the data is decodable
+        self._raw.flush()
+        self.pending = 0
+
+    def close(self):
+        """
+        Finish the compressed stream and replace the table with it.
+        """
+        if self._raw.closed:
+            return
+        if self._held:
+            self.flush()
+        self._fh.close()  # also closes the gzip stream
+        self._raw.close()
+        if self.rows == 0 and not self._copied:
+            # like itsdb.ItsdbProfile.write_table(), don't write an
+            # empty gzipped table
+            os.remove(self.tmppath)
+            if self._base is not None:
+                os.remove(self.basepath)
+            return
+        if self._base is not None:
+            _append_member(self.tmppath, self.path, self._base)
+            os.remove(self.tmppath)
+            os.remove(self.basepath)
+        else:
+            os.replace(self.tmppath, self.path)
+        # an uncompressed table would shadow the new one
+        if os.path.isfile(self.txtpath):
+            os.remove(self.txtpath)
+
+
+def recover(root, table):
+    """
+    Finalize the temporary file of a [TableWriter] for *table* in
+    the profile at *root* that was interrupted before it was closed.
+
+    All complete rows that were flushed are kept. Returns `True` if
+    a table was recovered.
+    """
+    path = os.path.join(root, table + '.gz')
+    tmppath = path + _TMP_SUFFIX
+    basepath = tmppath + _BASE_SUFFIX
+    if not os.path.isfile(tmppath):
+        if os.path.isfile(basepath):
+            os.remove(basepath)
+        return False
+    base = None
+    if os.path.isfile(basepath):
+        with open(basepath) as fh:
+            base = int(fh.read())
+    rows = 0
+    recovered = path + '.recovered'
+    with gzip.open(recovered, 'wt', encoding='utf-8') as out:
+        try:
+            with gzip.open(tmppath, 'rt', encoding='utf-8') as fh:
+                for line in fh:
+                    if not line.endswith('\n'):
+                        break  # partially written row
+                    out.write(line)
+                    rows += 1
+        except (EOFError, OSError):
+            pass  # the stream ends after the last flush
+    if base is not None:
+        # the rows were to be appended; an interrupted append is
+        # undone before appending them again
+        _append_member(recovered if rows > 0 else None, path, base)
+        os.remove(recovered)
+        os.remove(basepath)
+    elif rows > 0:
+        os.replace(recovered, path)
+    else:
+        os.remove(recovered)
+    os.remove(tmppath)
+    txtpath = os.path.join(root, table)
+    if os.path.isfile(txtpath):
+        os.remove(txtpath)
+    logging.info('Recovered {} rows of interrupted table {}'
+                 .format(rows, table))
+    return True
+
+
+def discard(root, table):
+    """
+    Remove any temporary file of a [TableWriter] for *table* in the
+    profile at *root*.
+    """
+    tmppath = os.path.join(root, table + '.gz' + _TMP_SUFFIX)
+    for path in (tmppath, tmppath + _BASE_SUFFIX):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _append_member(src, dest, base):
+    # truncate *dest* to its size *base* before any interrupted append
+    # and append the gzip stream in *src* (if any); the data is synced
+    # so the temporary files are only removed once it is durable
+    with open(dest, 'r+b') as dst:
+        dst.truncate(base)
+        if src is not None:
+            dst.seek(base)
+            with open(src, 'rb') as fh:
+                shutil.copyfileobj(fh, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
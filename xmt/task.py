@@ -1,13 +1,25 @@
 
 import os
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict, defaultdict
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+from functools import partial
+from itertools import groupby, islice
+import queue
+import select
+import threading
+from subprocess import TimeoutExpired
+import time
 import logging
 
 from delphin.interfaces import ace
+from delphin.interfaces.base import ParseResponse
 from delphin import itsdb
 
-from xmt import util
+from xmt import (
+    util, cache, schedule, tables, stats, columnar, phases, profiling
+)
 
 _TaskDefinition = namedtuple(
     'TaskDefinition',
@@ -39,57 +51,310 @@ tasks = {
     )
 }
 
+_END_OF_QUEUE = object()
+
+# the error recorded for inputs left out by a --budget-* option; like
+# other errors, --resume processes them
+SKIPPED = 'skipped: over budget'
+
+# the number of distinct recent inputs whose responses are reused for
+# identical inputs (e.g., transfers yielding the same MRS)
+_RECENT_INPUTS = 1000
+
+# a reentrant lock per profile for its run.conf (see _config_lock())
+_config_locks = defaultdict(threading.RLock)
+_config_locks_lock = threading.Lock()
+
 
 def do(taskname, args):
+    numitems = len(args['ITEM'])
+    width = len(str(numitems))
+    processes = int(args.get('--profiles-parallel') or 1)
+    func = partial(_do_item, taskname, args)
+    for i, itemdir in enumerate(
+            util.map_items(func, args['ITEM'], processes=processes)):
+        logging.info(
+            '{0} done {1:{2}d}/{3} {4}'
+            .format(taskname.title(), i+1, width, numitems, itemdir)
+        )
+
+
+def translate(args):
+    """
+    Parse, transfer, and generate each profile in a single pipeline.
+    """
+    tasknames = ('parse', 'transfer', 'generate')
+    numitems = len(args['ITEM'])
+    width = len(str(numitems))
+    processes = int(args.get('--profiles-parallel') or 1)
+    func = partial(_pipeline_item, tasknames, args)
+    for i, itemdir in enumerate(
+            util.map_items(func, args['ITEM'], processes=processes)):
+        logging.info(
+            'Translate done {0:{1}d}/{2} {3}'
+            .format(i+1, width, numitems, itemdir)
+        )
+
+
+def _do_item(taskname, args, i, itemdir, recorder=None):
     task = tasks[taskname]
     infotbl = task.prefix + '-info'
     rslttbl = task.prefix + '-result'
     numitems = len(args['ITEM'])
     width = len(str(numitems))
+    jobs = int(args.get('--jobs') or 1)
 
-    for i, itemdir in enumerate(args['ITEM']):
-        itemdir = os.path.normpath(itemdir)
-        logging.info(
-            '{0} {1:{2}d}/{3} {4}'
-            .format(taskname.title(), i+1, width, numitems, itemdir)
-        )
+    itemdir = os.path.normpath(itemdir)
+    logging.info(
+        '{0} {1:{2}d}/{3} {4}'
+        .format(taskname.title(), i+1, width, numitems, itemdir)
+    )
+    with _config_lock(itemdir):
         config = _item_config(taskname, itemdir, args)
-        with open(os.path.join(itemdir, 'run.conf'), 'w') as fh:
-            config.write(fh)
-        task_conf = config[taskname]
-        n = task_conf.getint('num-results', -1)
-        bufsize = task_conf.getint('result-buffer-size', fallback=500)
+        _write_config(itemdir, config)
+    task_conf = config[taskname]
+    processes = int(args.get('--profiles-parallel') or 1)
+    jobs = schedule.max_jobs(task_conf, jobs, concurrent=processes)
 
-        p = itsdb.ItsdbProfile(itemdir)
+    p = itsdb.ItsdbProfile(itemdir)
+    # read the costs of a previous run before its tables are cleared
+    history = None
+    if args.get('--schedule'):
+        history = _cost_history(p, task)
+    if args.get('--resume'):
+        # results are appended to the text table and packed again later
+        columnar.unpack_table(p, rslttbl)
+        tables.recover(p.root, infotbl)
+        tables.recover(p.root, rslttbl)
+        done = _prepare_resume(p, task)
+        logging.info('Resuming; {} inputs already processed'.format(len(done)))
+    else:
         # clear previous files
         _clear_itsdb_file(p.root, infotbl, True)
         _clear_itsdb_file(p.root, rslttbl, True)
+        columnar.remove(p.root, rslttbl)
+        tables.discard(p.root, infotbl)
+        tables.discard(p.root, rslttbl)
+        done = set()
+
+    rows = (row for row in phases.timed('table read',
+                                        columnar.read_table(p, task.in_table))
+            if _source_key(task, row) not in done)
+    budget = order = None
+    if args.get('--budget-results') or args.get('--budget-seconds'):
+        budget = _Budget(args.get('--budget-results'),
+                         args.get('--budget-seconds'))
+        if done:
+            _seed_budget(budget, p, taskname, done)
+        # best-first order within each item replaces --schedule; the
+        # results are still written in input order
+        order = _InputOrder(task)
+        rows = _rank_rows(order.number(rows), _score_function(p, task))
+        rows = budget.filter(rows, partial(_source_key, task),
+                             on_skip=order.skip)
+    elif history is not None:
+        order = _InputOrder(task)
+        rows = _schedule_rows(
+            task, order.number(rows), history,
+            window=task_conf.getint('schedule-window', fallback=100)
+        )
+    with ExitStack() as stack:
+        # stages run concurrently on one profile share a recorder
+        if recorder is None:
+            recorder = stack.enter_context(stats.RunRecorder(p))
+        _process(taskname, task_conf, p, rows, jobs=jobs, recorder=recorder,
+                 budget=budget, order=order)
+    if budget is not None and budget.skipped:
+        logging.info('Skipped {} inputs over budget'
+                     .format(len(budget.skipped)))
+        _append_rows(p, infotbl, [
+            dict(zip(task.id_fields, key),
+                 time=-1, memory=-1, error=SKIPPED)
+            for key in budget.skipped
+        ])
+    if columnar.enabled(p):
+        columnar.pack_table(p, rslttbl)
+    return itemdir
+
+
+def _pipeline_item(tasknames, args, i, itemdir):
+    """
+    Run the tasks in *tasknames* concurrently on *itemdir*, where each
+    task after the first takes its inputs directly from the results
+    of the previous one rather than from the profile.
+    """
+    numitems = len(args['ITEM'])
+    width = len(str(numitems))
+    jobs = int(args.get('--jobs') or 1)
+
+    itemdir = os.path.normpath(itemdir)
+    logging.info(
+        '{0} {1:{2}d}/{3} {4}'
+        .format(' -> '.join(tasknames), i+1, width, numitems, itemdir)
+    )
+    with _config_lock(itemdir):
+        config = _item_config(tasknames[0], itemdir, args)
+        for taskname in tasknames[1:]:
+            util._update_config(config[taskname], args, taskname)
+        _write_config(itemdir, config)
+    processes = int(args.get('--profiles-parallel') or 1)
+    jobs = min(
+        schedule.max_jobs(config[taskname], jobs,
+                          concurrent=processes * len(tasknames))
+        for taskname in tasknames
+    )
+
+    p = itsdb.ItsdbProfile(itemdir)
+    for taskname in tasknames:
+        for table in (tasks[taskname].prefix + '-info',
+                      tasks[taskname].prefix + '-result'):
+            _clear_itsdb_file(p.root, table, True)
+            columnar.remove(p.root, table)
+            tables.discard(p.root, table)
+
+    abort = threading.Event()
+    errors = []
+
+    def stage(taskname, rows, outq):
+        try:
+            emit = outq.put if outq is not None else None
+            rows = (row for row in rows if not abort.is_set())
+            _process(taskname, config[taskname], p, rows,
+                     jobs=jobs, emit=emit, recorder=recorder)
+        except BaseException as exc:
+            errors.append(exc)
+            abort.set()
+            for _ in rows:  # unblock upstream stages
+                pass
+        finally:
+            if outq is not None:
+                outq.put(_END_OF_QUEUE)
+
+    rows = phases.timed(
+        'table read', columnar.read_table(p, tasks[tasknames[0]].in_table)
+    )
+    threads = []
+    for j, taskname in enumerate(tasknames):
+        outq = None
+        if j + 1 < len(tasknames):
+            # bound the queue for backpressure on faster upstream stages
+            next_conf = config[tasknames[j + 1]]
+            outq = queue.Queue(
+                maxsize=next_conf.getint('result-buffer-size', fallback=500)
+            )
+        threads.append(threading.Thread(
+            target=profiling.thread(stage), args=(taskname, rows, outq),
+            name='{}:{}'.format(itemdir, taskname)
+        ))
+        rows = _iter_queue(outq) if outq is not None else None
+    with stats.RunRecorder(p) as recorder:
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            abort.set()
+            for thread in threads:
+                thread.join()
+            raise
+    if errors:
+        raise errors[0]
+    if columnar.enabled(p):
+        for taskname in tasknames:
+            columnar.pack_table(p, tasks[taskname].prefix + '-result')
+    return itemdir
+
 
-        with task.processor(
-                os.path.expanduser(task_conf['grammar']),
-                executable=task_conf['ace-bin'],
-                cmdargs=task.cmdargs + _get_cmdargs(task_conf),
-                tsdbinfo=task.tsdbinfo) as ap:
+def _iter_queue(q):
+    while True:
+        row = q.get()
+        if row is _END_OF_QUEUE:
+            break
+        yield row
 
-            inforows = []
-            resultrows = []
-            for row in p.read_table(task.in_table):
+
+def _process(taskname, task_conf, p, rows, jobs=1, emit=None,
+             recorder=None, budget=None, order=None):
+    """
+    Process *rows* with task *taskname* and append the info and result
+    rows to the tables of profile *p*. If *emit* is given, it is
+    called on each result row as soon as it is available. If
+    *recorder* is given, throughput statistics are recorded with it.
+    If *budget* is given, the results and time of each input are
+    charged to it. If *order* (an _InputOrder) is given, *rows* are
+    processed in their order but written in the input order it
+    recorded; otherwise they are written in the order of *rows*.
+    """
+    task = tasks[taskname]
+    n = task_conf.getint('num-results', -1)
+    flush_bytes = task_conf.getint('flush-kilobytes', fallback=1024) * 1024
+    flush_seconds = task_conf.getint('flush-seconds', fallback=60)
+
+    cache = _open_cache(task, task_conf)
+
+    start = time.time()
+    inputs = numresults = size = 0
+    ace_time = convert_time = write_time = 0.0
+
+    # the tables are replaced when the writers are closed, even on
+    # failure, so a run can be resumed
+    with ExitStack() as stack:
+        results = stack.enter_context(
+            tables.TableWriter(p, task.prefix + '-result', append=True)
+        )
+        # info rows reach the disk only after the results before them
+        infos = stack.enter_context(
+            tables.TableWriter(p, task.prefix + '-info', append=True,
+                               after=results)
+        )
+        last_flush = time.time()
+
+        def write(row, resultrows, inforow, queued, elapsed, cpu):
+            nonlocal inputs, numresults, size, write_time
+            t1 = time.time()
+            item_size = sum(results.write(r) for r in resultrows)
+            item_size += infos.write(inforow)
+            t2 = time.time()
+            inputs += 1
+            numresults += len(resultrows)
+            size += item_size
+            write_time += t2 - t1
+            phases.add('table write', t2 - t1)
+            if recorder is not None:
+                recorder.item(taskname, _source_key(task, row),
+                              queued, elapsed, cpu,
+                              len(resultrows), item_size)
+
+        def flush():
+            # checked after each response rather than each row written,
+            # as rows held back by *order* are written in bursts
+            nonlocal write_time, last_flush
+            pending = results.pending + infos.pending
+            if pending and (pending >= flush_bytes or
+                            time.time() - last_flush >= flush_seconds):
+                t1 = time.time()
+                logging.debug('Flushing results to disk.')
+                infos.flush()  # flushes the results first
+                last_flush = time.time()
+                write_time += last_flush - t1
+                phases.add('table write', last_flush - t1, calls=0)
+
+        try:
+            for row, response, (queued, elapsed) in _interact_all(
+                    task, task_conf, rows, jobs, cache=cache):
+                t0 = time.time()
                 logging.debug('Process: {}\t{}'.format(
-                    '|'.join(row[f] for f in task.id_fields),
+                    '|'.join(map(str, _source_key(task, row))),
                     row[task.in_field]
                 ))
-
-                response = ap.interact(row[task.in_field])
-                logging.debug('  {} results'.format(len(response['results'])))
+                logging.debug(
+                    '  {} results'.format(len(response['results']))
+                )
 
                 source_ids = [(f, row[f]) for f in task.id_fields]
 
-                inforows.append(dict(
-                    source_ids +    
-                    [('time', int(response.get('tcpu', -1))),
-                     ('memory', int(response.get('others', -1)))]
-                ))
-                    
+                resultrows = []
                 for i, result in enumerate(response.results()[:n]):
                     score = -1.0
                     for attr, val in result.get('flags', []):
@@ -101,17 +366,613 @@ def do(taskname, args):
                         [(task.prefix + '-id', i),
                          ('score', score)]
                     ))
+                cpu = int(response.get('tcpu', -1))
+                inforow = dict(
+                    source_ids +
+                    [('time', cpu),
+                     ('memory', int(response.get('others', -1))),
+                     ('error', _response_error(response))]
+                )
+                t1 = time.time()
+                ace_time += elapsed
+                convert_time += t1 - t0
+                phases.add('result conversion', t1 - t0)
+
+                if emit is not None:
+                    for resultrow in resultrows:
+                        emit(resultrow)
+                if budget is not None:
+                    budget.charge(row, len(resultrows), elapsed)
+
+                done = (row, resultrows, inforow, queued, elapsed, cpu)
+                if order is None:
+                    write(*done)
+                else:
+                    for entry in order.release(row, done):
+                        write(*entry)
+                flush()
+            if order is not None:
+                for entry in order.remaining():
+                    write(*entry)
+        finally:
+            if cache is not None:
+                logging.info('Cache: {} hits, {} misses'
+                             .format(cache.hits, cache.misses))
+                cache.close()
+    if recorder is not None:
+        recorder.task(taskname, start, jobs, time.time() - start, inputs,
+                      numresults, size, ace_time, convert_time, write_time)
+
+
+def _source_key(task, row):
+    return tuple(row[f] for f in task.id_fields)
+
+
+class _Budget(object):
+    """
+    Limit the results and ACE time spent on the inputs of each item.
+
+    Once the inputs of an item gave *results* results or took
+    *seconds* seconds, its remaining inputs are skipped. Inputs that
+    are already being processed when the budget runs out still
+    count, so an item may go over its budget by a few inputs.
+
+    Args:
+        results: the maximum number of results per item, or `None`
+        seconds: the maximum ACE time per item, or `None`
+    """
+
+    def __init__(self, results=None, seconds=None):
+        self.max_results = int(results) if results else None
+        self.max_seconds = float(seconds) if seconds else None
+        self.results = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.skipped = []  # the source keys of skipped inputs
+
+    def spent(self, i_id):
+        """
+        Return `True` if the budget of item *i_id* is used up.
+        """
+        return ((self.max_results is not None and
+                 self.results[i_id] >= self.max_results) or
+                (self.max_seconds is not None and
+                 self.seconds[i_id] >= self.max_seconds))
+
+    def charge(self, row, results, seconds):
+        """
+        Charge *results* results and *seconds* seconds to the item of
+        input *row*.
+        """
+        self.results[row['i-id']] += results
+        self.seconds[row['i-id']] += seconds
+
+    def filter(self, rows, key, on_skip=None):
+        """
+        Yield the rows of *rows* whose items have budget left, and
+        remember the keys (`key(row)`) of the others in `skipped`.
+        If *on_skip* is given, it is called with the key of each
+        skipped row.
+        """
+        for row in rows:
+            if self.spent(row['i-id']):
+                self.skipped.append(key(row))
+                if on_skip is not None:
+                    on_skip(key(row))
+            else:
+                yield row
+
+
+class _InputOrder(object):
+    """
+    Restore the input order of rows processed in a different order.
+
+    Rows are numbered as they are read from the input table with
+    number(); after they are reordered (e.g., by --schedule) and
+    processed, release() holds back each processed row until all
+    rows before it in the input are processed or skipped, so results
+    are written in input order regardless of the processing order.
+
+    Args:
+        task: the task definition of the rows
+    """
+
+    def __init__(self, task):
+        self.task = task
+        # positions of unreleased rows by source key; rows with the
+        # same key are released in input order
+        self.positions = defaultdict(deque)
+        self.ready = {}  # processed or skipped (None) rows by position
+        self.count = 0
+        self.next = 0
+
+    def number(self, rows):
+        """
+        Yield *rows*, recording the position of each in the input.
+        """
+        for row in rows:
+            self.positions[_source_key(self.task, row)].append(self.count)
+            self.count += 1
+            yield row
+
+    def skip(self, key):
+        """
+        Mark the row with source key *key* as not to be processed.
+        """
+        self.ready[self._position(key)] = None
+
+    def release(self, row, entry):
+        """
+        Mark *row* as processed with *entry* and return the entries
+        that can now be written, in input order.
+        """
+        self.ready[self._position(_source_key(self.task, row))] = entry
+        released = []
+        while self.next in self.ready:
+            entry = self.ready.pop(self.next)
+            self.next += 1
+            if entry is not None:
+                released.append(entry)
+        return released
+
+    def _position(self, key):
+        positions = self.positions[key]
+        position = positions.popleft()
+        if not positions:
+            del self.positions[key]
+        return position
+
+    def remaining(self):
+        """
+        Return the entries still held back, in input order; when all
+        rows have been processed or skipped, there are none.
+        """
+        released = [self.ready[i] for i in sorted(self.ready)]
+        self.ready.clear()
+        return [entry for entry in released if entry is not None]
+
+
+def _score_function(p, task):
+    """
+    Return a function giving the product of the score of an input row
+    of *task* in profile *p* and the scores of the results it was
+    derived from (e.g., of the parse of a transfer result). Unknown
+    (negative) scores count as 1.
+    """
+    producer = _producer(task.in_table)
+    if producer is None:
+        return lambda row: 1.0
+    upstream = _score_function(p, producer)
+    if producer.in_table == 'item':
+        scores = None
+    else:
+        scores = {_source_key(producer, row): upstream(row)
+                  for row in _read_available_rows(p, producer.in_table)}
+
+    def score(row):
+        s = _score(row)
+        if scores is not None:
+            s *= scores.get(_source_key(producer, row), 1.0)
+        return s
+    return score
 
-                if len(resultrows) >= bufsize:
-                    logging.debug('Writing intermediate results to disk.')
-                    p.write_table(infotbl, inforows, append=True, gzip=True)
-                    p.write_table(rslttbl, resultrows, append=True, gzip=True)
-                    inforows = []
-                    resultrows = []
 
-            # write remaining data; also gzip at this time
-            p.write_table(infotbl, inforows, append=True, gzip=True)
-            p.write_table(rslttbl, resultrows, append=True, gzip=True)
+def _producer(table):
+    for task in tasks.values():
+        if task.prefix + '-result' == table:
+            return task
+    return None
+
+
+def _score(row):
+    score = float(row.get('score') or -1)
+    return score if score >= 0 else 1.0
+
+
+def _rank_rows(rows, score):
+    """
+    Yield *rows* grouped by item, with the rows of each item in order
+    of decreasing *score* (see _score_function()).
+    """
+    for _, group in groupby(rows, key=lambda row: row['i-id']):
+        yield from sorted(group, key=score, reverse=True)
+
+
+def _cost_history(p, task):
+    """
+    Return a mapping of source keys to the (time, memory) recorded in
+    the info table of *task* in profile *p*.
+    """
+    history = {}
+    for row in _read_available_rows(p, task.prefix + '-info'):
+        history[_source_key(task, row)] = (
+            int(row.get('time') or -1), int(row.get('memory') or -1)
+        )
+    return history
+
+
+def _schedule_rows(task, rows, history, window=100):
+    """
+    Yield *rows* ordered by decreasing expected processing time as
+    predicted from the size of their inputs and the costs in
+    *history* (see _cost_history()).
+
+    Rows are ordered within consecutive windows of *window* rows, so
+    only that many are read ahead and the results held back to be
+    written in input order (see _InputOrder) stay few.
+    """
+    size = lambda row: len(row[task.in_field].split())
+    key = partial(_source_key, task)
+    rows = iter(rows)
+    model = None
+    while True:
+        chunk = list(islice(rows, window))
+        if not chunk:
+            return
+        observations = {}
+        for row in chunk:
+            if key(row) in history:
+                observations[key(row)] = (size(row),) + history[key(row)]
+        if model is None:
+            # sizes are fitted to the costs of the first window and
+            # later windows only add the costs of their own inputs
+            model = schedule.CostModel(observations)
+        else:
+            model.history.update(observations)
+        yield from model.order(chunk, key, size)
+
+
+def _response_error(response):
+    # with --tsdb-stdout ACE reports errors as :error; otherwise they
+    # are collected from ERROR: lines
+    error = response.get('error') or ' '.join(response.get('ERRORS', []))
+    return error.replace('\n', ' ').strip()
+
+
+def _prepare_resume(p, task):
+    """
+    Prepare the output tables of *task* in profile *p* for resuming a
+    previous run and return the set of source keys already processed.
+
+    Inputs whose info rows record an error are not considered
+    processed, so their info and result rows are removed in order for
+    them to be processed again. Result rows without a corresponding
+    info row (e.g., from an interrupted write) are removed as well.
+    """
+    infotbl = task.prefix + '-info'
+    rslttbl = task.prefix + '-result'
+    inforows = _read_available_rows(p, infotbl)
+    done = set(_source_key(task, row) for row in inforows
+               if not row.get('error'))
+    resultrows = _read_available_rows(p, rslttbl)
+    keep_info = [row for row in inforows
+                 if _source_key(task, row) in done]
+    keep_results = [row for row in resultrows
+                    if _source_key(task, row) in done]
+    if (len(keep_info) < len(inforows) or
+            len(keep_results) < len(resultrows)):
+        logging.info(
+            'Removing {} info rows and {} result rows to reprocess'
+            .format(len(inforows) - len(keep_info),
+                    len(resultrows) - len(keep_results))
+        )
+        _clear_itsdb_file(p.root, infotbl, True)
+        _clear_itsdb_file(p.root, rslttbl, True)
+        _append_rows(p, infotbl, keep_info)
+        _append_rows(p, rslttbl, keep_results)
+    return done
+
+
+def _seed_budget(budget, p, taskname, done):
+    """
+    Charge *budget* with the results and ACE time of the inputs of
+    *taskname* in profile *p* that a previous run already processed
+    (the source keys in *done*), so a resumed run does not spend the
+    budget of each item again.
+    """
+    task = tasks[taskname]
+    for row in _read_available_rows(p, task.prefix + '-result'):
+        if _source_key(task, row) in done:
+            budget.charge(row, 1, 0)
+    # the time charged is the wall time recorded in the run statistics
+    # of the latest run of each input, or else ACE's time in the info row
+    times = stats.input_times(p, taskname)
+    for row in _read_available_rows(p, task.prefix + '-info'):
+        key = _source_key(task, row)
+        if key in done:
+            seconds = times.get(key, int(row.get('time') or -1) / 1000)
+            if seconds > 0:
+                budget.charge(row, 0, seconds)
+
+
+def _read_available_rows(p, table):
+    """
+    Return the rows of *table* in profile *p* that can be read; a
+    missing table has no rows and a table truncated by an interrupted
+    write has only the rows before the truncation.
+    """
+    rows = []
+    try:
+        for row in columnar.read_table(p, table):
+            rows.append(row)
+    except itsdb.ItsdbError:
+        pass
+    except (EOFError, OSError):
+        logging.warning(
+            'Table {} is truncated; ignoring rows after {}'
+            .format(table, len(rows))
+        )
+    return rows
+
+
+def _processor(task, task_conf):
+    def make_processor():
+        # the processor may modify cmdargs, so make a new list each time
+        return task.processor(
+            os.path.expanduser(task_conf['grammar']),
+            executable=task_conf['ace-bin'],
+            cmdargs=task.cmdargs + _get_cmdargs(task_conf),
+            tsdbinfo=task.tsdbinfo
+        )
+    return _SupervisedProcessor(
+        make_processor,
+        task_conf.getint('watchdog-timeout', fallback=300)
+    )
+
+
+class _SupervisedProcessor(object):
+    """
+    An ACE processor that is restarted when it dies or hangs.
+
+    If ACE crashes, or does not respond to an input within *timeout*
+    seconds (regardless of ACE's own --timeout), the process is
+    killed and restarted and the input gets a response with an error
+    instead of results, so processing can continue with the next one.
+
+    Args:
+        make_processor: a function returning a new ACE processor
+        timeout: seconds to wait for a response; if 0, wait forever
+    """
+
+    def __init__(self, make_processor, timeout=0):
+        self._make_processor = make_processor
+        self.timeout = timeout
+        self.ap = make_processor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def interact(self, datum):
+        ap = self.ap
+        process = _subprocess(ap)
+        watchdog = _Watchdog(process, self.timeout)
+        error = None
+        try:
+            response = ap.interact(datum)
+        except Exception as exc:
+            error = 'ACE failed: {}'.format(exc)
+        finally:
+            killed = watchdog.stop()
+        # pydelphin reopens a process that closed while it was reading
+        # a response, in which case it need not be restarted again
+        reopened = _subprocess(ap) is not process
+        if killed:
+            # a killed process can look like an empty response
+            error = 'ACE killed after {} seconds'.format(self.timeout)
+        elif error is None and (reopened or _process_died(process)):
+            error = 'ACE process died'
+        if error is not None:
+            logging.error('{}; input: {}'.format(error, datum))
+            response = ParseResponse({
+                'input': datum, 'results': [], 'ERRORS': [error]
+            })
+            if reopened:
+                _reap(process)
+            else:
+                self._restart()
+        return response
+
+    def _restart(self):
+        _reap(_subprocess(self.ap), kill=True)
+        logging.info('Restarting ACE')
+        self.ap = self._make_processor()
+
+    def close(self):
+        return self.ap.close()
+
+
+class _Watchdog(object):
+    """
+    Kill *process* unless stop() is called within *timeout* seconds.
+
+    The timer and stop() share a lock, so once stop() was called, the
+    process is not killed even if the timer fires (e.g., while the
+    process works on the next input).
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.killed = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._timer = None
+        if timeout > 0 and process is not None:
+            self._timer = threading.Timer(timeout, self._kill)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _kill(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self.killed = True
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def stop(self):
+        """
+        Stop the watchdog and return `True` if it killed the process.
+        """
+        with self._lock:
+            self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+        return self.killed
+
+
+def _subprocess(ap):
+    # pydelphin (<= 0.6) has no public access to the ACE subprocess,
+    # which is needed to kill it and to see if it died; without it
+    # (e.g., in later versions) ACE is not supervised
+    return getattr(ap, '_p', None)
+
+
+def _reap(process, kill=False):
+    if process is None:
+        return
+    try:
+        if kill:
+            process.kill()
+        process.wait()
+    except OSError:
+        pass
+
+
+def _process_died(process):
+    # a dead process may not be noticed by the processor, as the empty
+    # reads at the end of its output can look like a finished response
+    if process is None:
+        return False
+    if process.poll() is not None:
+        return True
+    readable, _, _ = select.select([process.stdout], [], [], 0)
+    if readable:
+        # end of output or (rarely) output after the response
+        try:
+            process.wait(timeout=1)
+        except TimeoutExpired:
+            return False
+        return True
+    return False
+
+
+def _open_cache(task, task_conf):
+    path = task_conf.get('cache')
+    if not path:
+        return None
+    grammar = os.path.expanduser(task_conf['grammar'])
+    namespace = [
+        cache.grammar_digest(grammar),
+        task.processor.__name__,
+        task.tsdbinfo,
+        task.cmdargs + _get_cmdargs(task_conf)
+    ]
+    max_size = task_conf.getint('cache-megabytes', fallback=1024)
+    return cache.AceCache(os.path.expanduser(path), namespace,
+                          max_size=max_size * 1024 * 1024)
+
+
+def _interact(ap, datum, cache=None):
+    if cache is None:
+        return ap.interact(datum)
+    response = cache.get(datum)
+    if response is None:
+        response = ap.interact(datum)
+        # errors (e.g., timeouts) may not recur, so don't cache them
+        if not _response_error(response):
+            cache.put(datum, response)
+    return response
+
+
+def _interact_all(task, task_conf, rows, jobs=1, cache=None):
+    """
+    Yield (row, response, timing) triples for each of *rows*, in
+    order, where *timing* is a pair of the seconds spent waiting for
+    an ACE process and the seconds spent interacting with it.
+
+    If *jobs* is greater than 1, that many ACE processes are started
+    and the rows are distributed among them, but the triples are
+    still yielded in the order of *rows*. Rows whose input is the same as
+    that of a recent row share its response instead of being sent to
+    ACE again. If *cache* is given, responses are looked up in and
+    added to it.
+    """
+    with ExitStack() as stack:
+        idle = queue.Queue()
+        for _ in range(max(jobs, 1)):
+            idle.put(stack.enter_context(_processor(task, task_conf)))
+
+        @profiling.thread
+        def interact(datum, submitted):
+            ap = idle.get()
+            started = time.time()
+            try:
+                response = _interact(ap, datum, cache)
+            finally:
+                idle.put(ap)
+            return response, (started - submitted, time.time() - started)
+
+        if jobs <= 1:
+            submit = _submit_now
+        else:
+            submit = stack.enter_context(
+                ThreadPoolExecutor(max_workers=jobs)
+            ).submit
+
+        # keep a bounded window of pending rows so results can be
+        # yielded in order without reading the whole table
+        window = max(jobs, 1) * 2
+        pending = deque()
+        recent = OrderedDict()
+        duplicates = 0
+        for row in rows:
+            datum = row[task.in_field]
+            future = recent.get(datum)
+            duplicate = future is not None
+            if not duplicate:
+                # without a pool, submitting waits for the response
+                with phases.phase('ACE wait'):
+                    future = submit(interact, datum, time.time())
+                recent[datum] = future
+                if len(recent) > _RECENT_INPUTS:
+                    recent.popitem(last=False)
+            else:
+                recent.move_to_end(datum)
+                duplicates += 1
+            pending.append((row, future, duplicate))
+            if len(pending) >= window:
+                yield _pending_result(*pending.popleft())
+        while pending:
+            yield _pending_result(*pending.popleft())
+        if duplicates:
+            logging.info('{} duplicate inputs were not sent to ACE'
+                         .format(duplicates))
+
+
+def _pending_result(row, future, duplicate):
+    with phases.phase('ACE wait'):
+        response, timing = future.result()
+    if duplicate:
+        timing = (0.0, 0.0)  # the time was spent on the first input
+    return row, response, timing
+
+
+def _submit_now(func, *args):
+    # a stand-in for Executor.submit() that calls func immediately
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def _append_rows(p, table, rows):
+    with tables.TableWriter(p, table, append=True) as writer:
+        for row in rows:
+            writer.write(row)
 
 
 def _clear_itsdb_file(root, fn, clear_gzip):
@@ -122,14 +983,33 @@ def _clear_itsdb_file(root, fn, clear_gzip):
         os.remove(fn + '.gz')
 
 
+def _config_lock(itemdir):
+    """
+    Return the lock to hold while reading and writing the run.conf
+    of *itemdir*, so that stages run concurrently on the same profile
+    don't lose each other's configuration.
+    """
+    with _config_locks_lock:
+        return _config_locks[os.path.normpath(os.path.abspath(itemdir))]
+
+
+def _write_config(itemdir, config):
+    # readers (e.g., other processes) never see a partial file
+    path = os.path.join(itemdir, 'run.conf')
+    with open(path + '.tmp', 'w') as fh:
+        config.write(fh)
+    os.replace(path + '.tmp', path)
+
+
 def _item_config(section, itemdir, args):
-    workspace = os.path.dirname(itemdir)
-    config = ConfigParser()
-    config.read([
-        os.path.join(workspace, 'default.conf'),
-        os.path.join(itemdir, 'run.conf')
-    ])
-    util._update_config(config[section], args, section)
+    with _config_lock(itemdir), phases.phase('config loading'):
+        workspace = os.path.dirname(itemdir)
+        config = ConfigParser()
+        config.read([
+            os.path.join(workspace, 'default.conf'),
+            os.path.join(itemdir, 'run.conf')
+        ])
+        util._update_config(config[section], args, section)
     return config
 
 
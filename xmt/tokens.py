@@ -0,0 +1,121 @@
+
+import os
+import json
+import gzip
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from xmt import util, phases
+
+# maximum number of tokenized strings kept in memory
+_MAX_SIZE = 200000
+
+_CACHE_FILE = 'tokens.json.gz'
+
+# tables whose strings may be in a profile's token cache
+SOURCE_TABLES = ('item', 'g-result', 'r-result')
+
+_tokenizers = {}
+_cache = OrderedDict()
+_recording = None
+
+
+def _tokenizer(name):
+    if name not in _tokenizers:
+        if name == 'moses':
+            from nltk.tokenize.moses import MosesTokenizer
+            _tokenizers[name] = MosesTokenizer().tokenize
+        elif name == 'toktok':
+            from nltk.tokenize.toktok import ToktokTokenizer
+            _tokenizers[name] = ToktokTokenizer().tokenize
+        else:
+            raise ValueError('unknown tokenizer: {}'.format(name))
+    return _tokenizers[name]
+
+
+def tokenize(s, tokenizer='toktok', lowercase=False):
+    """
+    Return the tuple of tokens of string *s*.
+
+    Results are remembered in a least-recently-used cache keyed on
+    *tokenizer*, *lowercase*, and *s*, so strings that recur, such as
+    references scored against many hypotheses, are only tokenized
+    once.
+
+    Args:
+        s: the string to tokenize
+        tokenizer: `'toktok'` or `'moses'`
+        lowercase: if `True`, lowercase *s* before tokenizing
+    """
+    key = (tokenizer, lowercase, s)
+    try:
+        toks = _cache[key]
+        _cache.move_to_end(key)
+    except KeyError:
+        with phases.phase('tokenization'):
+            toks = tuple(
+                _tokenizer(tokenizer)(s.lower() if lowercase else s)
+            )
+        _cache[key] = toks
+        if len(_cache) > _MAX_SIZE:
+            _cache.popitem(last=False)
+    if _recording is not None:
+        _recording[key] = toks
+    return toks
+
+
+@contextmanager
+def profile_cache(p, tables=SOURCE_TABLES):
+    """
+    Persist the strings tokenized within the context in profile *p*.
+
+    On entry, tokens saved by a previous use are loaded if none of
+    *tables*, the tables the strings come from, have changed since.
+    On exit, the tokens of strings tokenized in the context are added
+    to the saved ones.
+    """
+    global _recording
+    path = os.path.join(p.root, _CACHE_FILE)
+    fingerprint = util.table_fingerprint(p.root, tables)
+    loaded = _load(path, fingerprint)
+    _cache.update(loaded)
+    while len(_cache) > _MAX_SIZE:
+        _cache.popitem(last=False)
+    _recording = OrderedDict()
+    try:
+        yield
+    finally:
+        recorded, _recording = _recording, None
+    if not recorded.keys() <= loaded.keys():
+        loaded.update(recorded)
+        _save(path, fingerprint, loaded)
+
+
+def _load(path, fingerprint):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            data = json.load(fh)
+    except (OSError, EOFError, ValueError):
+        logging.warning('Ignoring unreadable token cache {}'.format(path))
+        return {}
+    if data.get('fingerprint') != fingerprint:
+        logging.debug('Token cache {} is out of date'.format(path))
+        return {}
+    return OrderedDict(
+        ((tokenizer, lowercase, s), tuple(toks))
+        for tokenizer, lowercase, s, toks in data['tokens']
+    )
+
+
+def _save(path, fingerprint, tokens):
+    data = {
+        'fingerprint': fingerprint,
+        'tokens': [list(key) + [list(toks)] for key, toks in tokens.items()]
+    }
+    tmppath = path + '.tmp'
+    with gzip.open(tmppath, 'wt', encoding='utf-8') as fh:
+        json.dump(data, fh)
+    os.replace(tmppath, path)
@@ -1,13 +1,103 @@
 
+import os
+import hashlib
+import concurrent.futures
+from functools import partial
+
+from xmt import phases, profiling
+
+
+def map_items(func, items, processes=1):
+    """
+    Yield the result of `func(i, item)` for each of *items*, in order.
+
+    If *processes* is greater than 1, the items are processed
+    concurrently in a pool of that many worker processes, so *func*
+    and its return value must be picklable.
+    """
+    indices = range(len(items))
+    if processes <= 1:
+        yield from map(func, indices, items)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        with pool:
+            for output in pool.map(worker(func), indices, items):
+                yield collect(output)
+
+
+def worker(func):
+    """
+    Wrap *func* to be called in a worker process. The wrapper returns
+    the result of *func* together with the phase times of the call and
+    profiles it if the command is profiled; collect() takes the
+    result from its return value.
+    """
+    return partial(_call_worker, func, profiling.worker_path())
+
+
+def collect(output):
+    """
+    Return the result of a function wrapped with worker() from its
+    return value *output* and add the phase times of the call to
+    those of this process.
+    """
+    result, times = output
+    for name, seconds, calls in times:
+        phases.add(name, seconds, calls)
+    return result
+
+
+def _call_worker(func, profile_path, *args):
+    # a worker process runs one call after another, so its phase
+    # times are those of the current call
+    phases.reset()
+    with profiling.worker(profile_path):
+        result = func(*args)
+    return result, phases.totals()
+
+
+def table_fingerprint(root, tables):
+    """
+    Return a list of [filename, size, mtime] triples for the files
+    of *tables* (plain, gzipped, or columnar) in the profile at *root*.
+    Missing tables are left out.
+    """
+    fp = []
+    for table in tables:
+        # the metadata of a columnar table changes whenever it is packed
+        for filename in (table, table + '.gz',
+                         os.path.join(table + '.col', 'meta.json')):
+            path = os.path.join(root, filename)
+            if os.path.isfile(path):
+                st = os.stat(path)
+                fp.append([filename, st.st_size, st.st_mtime_ns])
+    return fp
+
+
+def file_digest(path):
+    """
+    Return the hex SHA-1 digest of the contents of the file at *path*.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def _update_config(cfg, args, task):
     if args.get('--ace-bin') is not None:
         cfg['ace-bin'] = args.get('--ace-bin')
+    if args.get('--cache') is not None:
+        cfg['cache'] = os.path.abspath(os.path.expanduser(args['--cache']))
     if args.get('-g') is not None:
         cfg['grammar'] = args.get('-g')
     if args.get('-n') is not None:
         cfg['num-results'] = args.get('-n')
     if args.get('--timeout') is not None:
         cfg['timeout'] = args.get('--timeout')
+    if args.get('--watchdog-timeout') is not None:
+        cfg['watchdog-timeout'] = args.get('--watchdog-timeout')
     if task == 'parse':
         if args.get('--max-chart-megabytes') is not None:
             cfg['max-chart-megabytes'] = args.get('--max-chart-megabytes')